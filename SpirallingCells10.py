@@ -13,18 +13,51 @@
 #
 # import packages:
 import sys
+import os
 import time
 import math
-import random
-import pygame
-from pygame.locals import *
-from copy import deepcopy
+import argparse
+import multiprocessing
+import threading
+import collections
+import itertools
+import json
+import platform
+import tempfile
+import shutil
+import Queue
 import pickle
+import struct
+import zlib
+import numpy as np
 import datetime
 import timeit
 import cProfile
-from Tkinter import *
-import Tkinter, Tkconstants, tkFileDialog
+import pstats
+import copy
+# pygame, Tkinter and tkFileDialog are imported by import_gui() when the
+# interactive mode starts, so batch runs work without a display.
+
+
+######################################################################
+#
+# number of physical CPU cores, hyper-threads of one core share the vector
+# units the NumPy engines depend on. Read from /proc/cpuinfo (Linux),
+# elsewhere the number of logical CPUs is used:
+def physical_cpu_count():
+    cores = set()
+    physical_id = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key.strip() == "physical id":
+                    physical_id = value.strip()
+                elif key.strip() == "core id":
+                    cores.add((physical_id, value.strip()))
+    except IOError:
+        pass
+    return len(cores) or multiprocessing.cpu_count()
 
 
 ######################################################################
@@ -48,7 +81,51 @@ COLOR_SEQ = ["BLUE", "YELLOW", "BROWN", "RED", "GREY2", "GREEN", "WHITE",
              "DARKBLUE", "PINK", "OLIVE", "LIGHTBLUE", "LIGHTRED",
              "LIGHTGREEN", "BLACK", "GREY1", "LAVENDER"]
 PALETTE = [COLORS[color] for color in COLOR_SEQ]
+PALETTE_RGB = np.array(PALETTE, dtype=np.uint8)   # lookup array state -> colour
+DIRTY_TILE = 32       # tile size (in cells) for redrawing changed cells only
+MAX_PIXEL_SIZE = 16   # viewport: max. zoom, pixels per cell
+PYRAMID_RECT_CELLS = 8192   # pyramid: overhead of updating one dirty block, in cells of a full update
 VERSION = "1.0"       # program version
+ENGINES = ["active", "numpy", "parallel", "memo", "list"]   # available stepping engines, see CellularAutomaton
+ENGINE = "active"     # default stepping engine
+ACTIVE_DENSE_FRACTION = 0.15   # active engine: sweep whole grid if the active cells may exceed this fraction
+                               # (measured break-even, von Neumann: 0.15, Moore: 0.28)
+CELL_DTYPE = np.uint8  # storage type of cell states, one byte per cell (num_states <= 16)
+WORKERS = physical_cpu_count()   # parallel engine: number of worker processes
+MEMO_BLOCK = 8        # memo engine: block size in cells, blocks are cached with a halo of one cell
+MEMO_CACHE_SIZE = 1 << 18     # memo engine: max. number of cached blocks
+SNAPSHOT_MAGIC = "SPIRCELL"   # first bytes of a snapshot file
+SNAPSHOT_VERSION = 1          # snapshot format version
+SNAPSHOT_HEADER = struct.Struct("<8sHHIIIIBxxxQ")   # see save_snapshot
+SNAPSHOT_HEADER_SIZE = 64     # header is padded so the cell buffer is aligned
+SNAPSHOT_BLOCK = 1 << 20      # number of cells per compressed block
+NEIGHBOURHOODS = ["von Neumann", "Moore"]   # stored as index in snapshot files
+TRAJECTORY_MAGIC = "SPIRTRAJ" # first bytes of a trajectory file
+TRAJECTORY_HEADER = struct.Struct("<8sHIIIIBxxxI")  # see TrajectoryRecorder
+TRAJECTORY_RECORD = struct.Struct("<BQI")   # record type, iteration, payload size
+TRAJECTORY_INDEX = struct.Struct("<BQQ")    # record type, iteration, file offset
+KEYFRAME_INTERVAL = 100       # trajectory: store full grid every this many generations
+RECORDER_QUEUE = 64           # trajectory: max. number of generations waiting to be written
+EXPORT_QUEUE = 16             # export: max. number of frames waiting to be encoded
+GIF_DELAY = 4                 # export: delay between GIF frames in 1/100 seconds
+TEMPORAL_BLOCK_CELLS = 1 << 20   # EvolveSteps: cells per band evolved several generations at once
+TEMPORAL_BLOCK_STEPS = 8      # EvolveSteps: max. number of generations per band
+GENS_PER_FRAME = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096]   # 0 = auto
+TARGET_FPS = 25               # frame rate aimed for if generations per frame is "auto"
+HASH_HISTORY = 4096           # cycle detection: number of recent grid hashes kept
+HASH_MASK = (1 << 64) - 1     # grid hashes are sums of cell hashes modulo 2**64
+ENTROPY_SAMPLE_BATCH = 10000  # EstimateEntropy: cells sampled per round
+ENTROPY_MAX_ERROR = 0.01      # EstimateEntropy: default half-width of 95% confidence interval
+PROFILE_PHASES = ["ui", "wait", "draw", "display", "events"]   # timed parts of a frame
+SIMULATION_PHASES = ["evolve", "entropy"]   # timed parts of the simulation thread
+PROFILE_WINDOW = 120          # number of frames kept for timing statistics
+PROFILE_FRAMES = 100          # number of frames captured by cProfile (key "p")
+BENCHMARK_SIZES = [200, 400, 800]   # benchmarks: grid width and height
+BENCHMARK_STATES = [4, 8, 16]       # benchmarks: number of states
+BENCHMARK_SEED = 1            # benchmarks: seed for initial grids
+BENCHMARK_WARMUP = 20         # benchmarks: generations evolved before timing
+BENCHMARK_REPEATS = 5         # benchmarks: timed calls per case
+BENCHMARK_TOLERANCE = 0.2     # benchmarks: best time slower than baseline by this fraction is a regression
 
 ######################################################################
 #
@@ -59,6 +136,10 @@ iteration = 0                    # counter for interation number
 cell_size = 2                    # cell size for drawing (as square with sidelength cell_size)
 running = True                   # keep track of whether simulation is paused or not
 show_mindist = False             # show entropy, this slows simulation 
+gens_per_frame = 1               # generations computed between redraws, 0 = auto (TARGET_FPS)
+font_cache = {}                  # PyGame fonts by (name, size), see get_font
+grid_width = None                # grid size in interactive mode, None: fits window
+grid_height = None               # (MAIN_WIDTH // cell_size x HEIGHT // cell_size)
 
 ######################################################################
 #
@@ -77,6 +158,143 @@ def get_filename(prefix, num_states, cell_size, width, height, postfix):
                postfix
     return filename
 
+# hash values for cells, keys are flat cell index * 16 + state (uint64
+# array), uses the splitmix64 finalizer, arithmetic wraps modulo 2**64:
+def cell_hash(keys):
+    z = keys + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+# hash value of a whole grid, sum of the hash values of all cells, so it
+# can be updated incrementally from changed cells:
+def grid_hash(grid):
+    flat = np.asarray(grid, dtype=CELL_DTYPE).reshape(-1)
+    total = 0
+    for start in range(0, len(flat), SNAPSHOT_BLOCK):
+        keys = np.arange(start, min(start + SNAPSHOT_BLOCK, len(flat)), dtype=np.uint64) * \
+               np.uint64(16) + flat[start:start + SNAPSHOT_BLOCK]
+        total += int(cell_hash(keys).sum())
+    return total & HASH_MASK
+
+# return font, fonts are only created once:
+def get_font(name, size):
+    if (name, size) not in font_cache:
+        font_cache[(name, size)] = pygame.font.SysFont(name, size)
+    return font_cache[(name, size)]
+
+# ask for file to open with a tkinter dialog, returns path:
+def ask_open_filename():
+    tk_root = Tkinter.Tk()
+    file_path = tkFileDialog.askopenfilename()
+    tk_root.destroy()
+    return file_path
+
+# import GUI packages, only needed for interactive mode:
+def import_gui():
+    global Tkinter, tkFileDialog
+    import_pygame()
+    import Tkinter
+    import tkFileDialog
+
+# import PyGame, also used for drawing benchmarks without a window:
+def import_pygame():
+    global pygame
+    import pygame
+
+# convert grid (NumPy array or list of lists) to list of lists, this is
+# the format used in saved pickle files:
+def grid_as_list(grid):
+    if isinstance(grid, np.ndarray):
+        return grid.tolist()
+    return [list(row) for row in grid]
+
+
+######################################################################
+#
+# Snapshot files: a fixed size header (magic, format version, flags,
+# num_states, width, height, cell_size, neighbourhood, iteration) is
+# followed by the raw cell buffer, one byte per cell in row order. If
+# flag bit 0 is set the buffer is zlib compressed in blocks of
+# SNAPSHOT_BLOCK cells, preceded by the number of blocks and their sizes.
+# Uncompressed snapshots are memory-mapped on loading.
+def save_snapshot(filename, grid, num_states, cell_size, neighbourhood, iteration,
+                  compress=False):
+    grid = np.ascontiguousarray(grid, dtype=CELL_DTYPE)
+    height, width = grid.shape
+    f = open(filename, "wb")
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 1 if compress else 0,
+                                  num_states, width, height, cell_size,
+                                  NEIGHBOURHOODS.index(neighbourhood), iteration)
+    f.write(header.ljust(SNAPSHOT_HEADER_SIZE, "\0"))
+    flat = grid.reshape(-1)
+    if compress:
+        blocks = [zlib.compress(flat[start:start + SNAPSHOT_BLOCK].tostring()) \
+                  for start in range(0, len(flat), SNAPSHOT_BLOCK)]
+        f.write(struct.pack("<I", len(blocks)))
+        f.write(struct.pack("<%dI" % len(blocks), *[len(block) for block in blocks]))
+        for block in blocks:
+            f.write(block)
+    else:
+        flat.tofile(f)
+    f.close()
+    return filename
+
+# check whether file is a snapshot file (and not an old pickle file):
+def is_snapshot(filename):
+    f = open(filename, "rb")
+    magic = f.read(len(SNAPSHOT_MAGIC))
+    f.close()
+    return magic == SNAPSHOT_MAGIC
+
+# load snapshot file, returns dictionary with header values and "grid":
+def load_snapshot(filename):
+    f = open(filename, "rb")
+    values = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+    magic, version, flags, num_states, width, height, cell_size, neighbourhood, iteration = values
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("not a SpirallingCells snapshot file: " + filename)
+    if version > SNAPSHOT_VERSION:
+        raise ValueError("unsupported snapshot version %d: %s" % (version, filename))
+    state = {"num_states": num_states, "width": width, "height": height,
+             "cell_size": cell_size, "neighbourhood": NEIGHBOURHOODS[neighbourhood],
+             "iteration": iteration}
+    if flags & 1:
+        f.seek(SNAPSHOT_HEADER_SIZE)
+        num_blocks = struct.unpack("<I", f.read(4))[0]
+        sizes = struct.unpack("<%dI" % num_blocks, f.read(4 * num_blocks))
+        grid = np.empty(width * height, dtype=CELL_DTYPE)
+        start = 0
+        for size in sizes:
+            block = np.frombuffer(zlib.decompress(f.read(size)), dtype=CELL_DTYPE)
+            grid[start:start + len(block)] = block
+            start += len(block)
+        state["grid"] = grid.reshape(height, width)
+    else:
+        # copy-on-write mapping: pages are read on demand, changes stay private
+        state["grid"] = np.memmap(filename, dtype=CELL_DTYPE, mode="c",
+                                  offset=SNAPSHOT_HEADER_SIZE, shape=(height, width))
+    f.close()
+    return state
+
+# read state from pickle file written by earlier versions:
+def load_pickle_state(filename):
+    f = open(filename, "rb")
+    state = {}
+    for key in ["num_states", "width", "height", "cell_size", "neighbourhood"]:
+        state[key] = pickle.load(f)
+    state["grid"] = np.array(pickle.load(f), dtype=CELL_DTYPE)
+    state["iteration"] = pickle.load(f)
+    f.close()
+    return state
+
+# convert pickle file written by earlier versions to a snapshot file:
+def convert_pickle(filename, compress=False):
+    state = load_pickle_state(filename)
+    new_filename = filename.rsplit(".", 1)[0] + ".cells"
+    return save_snapshot(new_filename, state["grid"], state["num_states"], state["cell_size"],
+                         state["neighbourhood"], state["iteration"], compress)
+
 
 ######################################################################
 #
@@ -90,9 +308,12 @@ class Button():
         self.text = text
         self.color = color
         self.tcolor = tcolor
+        self.text_surface = None
 
     def SetText(self, text):
-        self.text = text
+        if text != self.text:
+            self.text = text
+            self.text_surface = None
 
     def PlaceButton(self, surface, x, y):
         self.x = x
@@ -105,9 +326,10 @@ class Button():
         return surface
 
     def ButtonText(self, surface, x, y):
-        font_size = int(self.width // len(self.text))
-        font = pygame.font.SysFont("Arial", FONTSIZE)
-        text = font.render(self.text, 1, self.tcolor)
+        # text is rendered once and reused until it changes:
+        if self.text_surface is None:
+            self.text_surface = get_font("Arial", FONTSIZE).render(self.text, 1, self.tcolor)
+        text = self.text_surface
         surface.blit(text, ((x + self.width/2) - text.get_width()/2, (y + self.height/2) - text.get_height()/2))
         return surface
 
@@ -118,45 +340,508 @@ class Button():
                mouse[1] < self.y + self.height
 
 
+######################################################################
+#
+# Control section layout, positions are relative to the top left corner of
+# the control section (MAIN_WIDTH, HEADER_HEIGHT).
+# Buttons: text, width, colour, x, y, command, value:
+PANEL_BUTTONS = [("Start", 70, "GREEN", 10, 30, "start", None),
+                 ("Pause", 70, "LIGHTRED", 100, 30, "pause", None),
+                 ("Continue", 70, "GREEN", 10, 70, "continue", None),
+                 ("Restart", 70, "GREEN", 100, 70, "restart", None),
+                 ("Quit", 70, "RED", 55, 110, "quit", None),
+                 ("Neumann", 90, "LIGHTBLUE", 10, 230, "neighbourhood", "von Neumann"),
+                 ("Moore", 90, "LIGHTBLUE", 105, 230, "neighbourhood", "Moore"),
+                 ("4", 70, "LIGHTBLUE", 10, 320, "num_states", 4),
+                 ("8", 70, "LIGHTBLUE", 100, 320, "num_states", 8),
+                 ("12", 70, "LIGHTBLUE", 10, 360, "num_states", 12),
+                 ("16", 70, "LIGHTBLUE", 100, 360, "num_states", 16),
+                 ("current", 70, "LIGHTYELLOW", 10, 440, "save_current", None),
+                 ("initial", 70, "LIGHTYELLOW", 100, 440, "save_initial", None),
+                 ("image", 70, "LIGHTYELLOW", 10, 480, "save_image", None),
+                 ("load", 70, "LIGHTYELLOW", 100, 480, "load", None),
+                 ("1", 70, "LIGHTBLUE", 10, 560, "cell_size", 1),
+                 ("2", 70, "LIGHTBLUE", 100, 560, "cell_size", 2),
+                 ("3", 70, "LIGHTBLUE", 10, 600, "cell_size", 3),
+                 ("4", 70, "LIGHTBLUE", 100, 600, "cell_size", 4),
+                 ("switch off", 120, "LIGHTBLUE", 40, 720, "min_dist", None),
+                 ("-", 30, "LIGHTBLUE", 10, 760, "gens_per_frame", -1),
+                 ("+", 30, "LIGHTBLUE", 160, 760, "gens_per_frame", 1)]
+# fixed texts: text, x, y:
+PANEL_LABELS = [("Controls:", 45, 0), ("Neighbourhood:", 15, 160), ("No of states:", 15, 280),
+                ("Save options:", 25, 410), ("Cell size:", 25, 530), ("Iteration:", 15, 650),
+                ("Min Dist:", 15, 690)]
+# y positions of horizontal lines:
+PANEL_LINES = [150, 270, 400, 520, 640, 680]
+# texts changing at run time: name, x, y, font size:
+PANEL_FIELDS = [("neighbourhood", 20, 190, 24), ("num_states", 160, 280, 24),
+                ("cell_size", 160, 530, 24), ("iteration", 120, 650, 24),
+                ("min_dist", 120, 690, 24), ("gens_per_frame", 50, 765, 20)]
+
+
+# Control section (and header) as retained layer: everything that does not
+# change is rendered once into a background surface, only fields whose text
+# changed and buttons with new text are redrawn:
+class ControlPanel():
+
+    def __init__(self):
+        self.buttons = [(Button(width, 30, text, COLORS[color], COLORS["BLACK"]), command, value) \
+                        for text, width, color, x, y, command, value in PANEL_BUTTONS]
+        self.fields = dict((name, {"text": None, "surface": None, "rect": None}) \
+                           for name, x, y, size in PANEL_FIELDS)
+        self.rects = [pygame.Rect(0, 0, MAIN_WIDTH + MENU_WIDTH, HEADER_HEIGHT),
+                      pygame.Rect(MAIN_WIDTH, HEADER_HEIGHT, MENU_WIDTH, HEIGHT)]
+        self.dirty = []
+        self.background = pygame.Surface((MAIN_WIDTH + MENU_WIDTH, HEIGHT + HEADER_HEIGHT))
+        self.RenderBackground()
+
+    def RenderBackground(self):
+        # draw header, buttons, fixed texts and lines into background:
+        surface = self.background
+        font = get_font("Helvetica", 24)
+        surface.fill(COLORS["GREY2"], self.rects[1])
+        surface.fill(COLORS["LIGHTYELLOW"], self.rects[0])
+        draw_text(surface, font, "SpirallingCells " + VERSION + \
+                  " ==> https://github.com/RandyWaterhouse/SpirallingCells", (10, 10), COLORS["BLUE"])
+        draw_text(surface, font, "by Dr. Peter U.", (MAIN_WIDTH + 25, 10), COLORS["BLUE"])
+        for (button, command, value), layout in zip(self.buttons, PANEL_BUTTONS):
+            button.PlaceButton(surface, MAIN_WIDTH + layout[3], HEADER_HEIGHT + layout[4])
+        for text, x, y in PANEL_LABELS:
+            draw_text(surface, font, text, (MAIN_WIDTH + x, HEADER_HEIGHT + y), COLORS["BLACK"])
+        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 0), (MAIN_WIDTH, HEIGHT), 2)
+        for y in PANEL_LINES:
+            pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + y),
+                             (MAIN_WIDTH + MENU_WIDTH, HEADER_HEIGHT + y), 2)
+
+    def SetField(self, name, text):
+        # set text of field, it is only rendered again if it changed:
+        field = self.fields[name]
+        if text == field["text"]:
+            return
+        name, x, y, size = [layout for layout in PANEL_FIELDS if layout[0] == name][0]
+        text_surface = get_font("Helvetica", size).render(text, 1, COLORS["BLUE"])
+        rect = text_surface.get_rect(topleft=(MAIN_WIDTH + x, HEADER_HEIGHT + y))
+        self.dirty.append(rect.union(field["rect"]) if field["rect"] else rect)
+        field.update(text=text, surface=text_surface, rect=rect)
+
+    def SetButtonText(self, command, text):
+        # change text of button(s) for command:
+        for button, button_command, value in self.buttons:
+            if button_command == command and button.text != text:
+                button.SetText(text)
+                button.PlaceButton(self.background, button.x, button.y)
+                self.dirty.append(pygame.Rect(button.x, button.y, button.width, button.height))
+
+    def Draw(self, surface, full=False):
+        # copy changed parts of control section (everything if full is True)
+        # to surface, returns list of changed rectangles:
+        rects = self.rects if full else self.dirty
+        for rect in rects:
+            surface.blit(self.background, rect, rect)
+        for field in self.fields.values():
+            if field["surface"] is not None and field["rect"].collidelist(rects) != -1:
+                surface.blit(field["surface"], field["rect"])
+        self.dirty = []
+        return list(rects)
+
+    def HitTest(self, position):
+        # command and value of button at position, (None, None) if none:
+        for button, command, value in self.buttons:
+            if button.IsPressed(position):
+                return command, value
+        return None, None
+
+
+######################################################################
+#
+# Frame timer for main loop: Mark(phase) adds the time since the last mark
+# to the given phase of the current frame, the simulation thread reports
+# its SIMULATION_PHASES as spans with each frame. The last PROFILE_WINDOW frames
+# are kept for the statistics overlay and for export as trace file (Chrome
+# trace event format, can be opened in chrome://tracing):
+class FrameTimer():
+
+    def __init__(self):
+        self.frames = collections.deque(maxlen=PROFILE_WINDOW)
+        self.origin = timeit.default_timer()
+        self.StartFrame()
+
+    def StartFrame(self):
+        self.frame_start = self.last = timeit.default_timer()
+        self.phases = [0.0] * len(PROFILE_PHASES)
+
+    def Mark(self, phase):
+        now = timeit.default_timer()
+        self.phases[PROFILE_PHASES.index(phase)] += now - self.last
+        self.last = now
+
+    def EndFrame(self, generations, cells, spans=()):
+        # store frame with number of generations and cells evolved, and the
+        # (phase, start, seconds) spans of the simulation thread:
+        self.frames.append((self.frame_start, self.last - self.frame_start, self.phases,
+                            generations, cells, spans))
+        self.StartFrame()
+
+    def Statistics(self):
+        # mean ms per phase and per simulation phase, generations per second
+        # and cells per second:
+        total = sum(frame[1] for frame in self.frames) or 1e-9
+        count = max(len(self.frames), 1)
+        phase_ms = [1000.0 * sum(frame[2][i] for frame in self.frames) / count \
+                    for i in range(len(PROFILE_PHASES))]
+        simulation_ms = [1000.0 * sum(seconds for frame in self.frames for name, start, seconds \
+                                      in frame[5] if name == phase) / count \
+                         for phase in SIMULATION_PHASES]
+        return phase_ms, simulation_ms, sum(frame[3] for frame in self.frames) / total, \
+               sum(frame[4] for frame in self.frames) / total
+
+    def DrawOverlay(self, surface, font):
+        # draw statistics in top left corner of the cell area, returns rectangle:
+        phase_ms, simulation_ms, generations, cells = self.Statistics()
+        lines = ["%-8s %7.2f ms" % (phase, ms) for phase, ms in zip(PROFILE_PHASES, phase_ms)]
+        lines += ["frame    %7.2f ms" % sum(phase_ms), "simulation thread:"]
+        lines += ["%-8s %7.2f ms" % (phase, ms) for phase, ms in zip(SIMULATION_PHASES, simulation_ms)]
+        lines += ["gen/s %10.1f" % generations, "cells/s %8.2e" % cells]
+        rect = pygame.Rect(5, HEADER_HEIGHT + 5, 190, 18 * len(lines) + 10)
+        surface.fill(COLORS["BLACK"], rect)
+        for i, line in enumerate(lines):
+            draw_text(surface, font, line, (rect.x + 5, rect.y + 5 + 18 * i), COLORS["WHITE"])
+        return rect
+
+    def SaveTrace(self, filename):
+        # save frames as trace events, one event per phase, the spans of the
+        # simulation thread on a track of their own, times in microseconds:
+        events = []
+        for start, duration, phases, generations, cells, spans in self.frames:
+            events.append({"name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                           "ts": 1e6 * (start - self.origin), "dur": 1e6 * duration,
+                           "args": {"generations": generations, "cells": cells}})
+            offset = start
+            for phase, seconds in zip(PROFILE_PHASES, phases):
+                events.append({"name": phase, "ph": "X", "pid": 1, "tid": 2,
+                               "ts": 1e6 * (offset - self.origin), "dur": 1e6 * seconds})
+                offset += seconds
+            for phase, span_start, seconds in spans:
+                events.append({"name": phase, "ph": "X", "pid": 1, "tid": 3,
+                               "ts": 1e6 * (span_start - self.origin), "dur": 1e6 * seconds})
+        f = open(filename, "w")
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        f.close()
+        return filename
+
+
+######################################################################
+#
+# Downsampled copies of the grid for zoomed-out views: level k has one cell
+# per 2**k x 2**k block of the grid, holding the majority state of the four
+# level k - 1 cells below it. Changed cells are collected in a boolean grid,
+# Update reduces it to tiles of DIRTY_TILE x DIRTY_TILE cells and only
+# recomputes the blocks above dirty tiles (unless recomputing the whole
+# level is cheaper):
+class GridPyramid():
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.levels = [None]             # level 0 is the grid itself
+        while height > 1 or width > 1:
+            height, width = -(-height // 2), -(-width // 2)
+            self.levels.append(np.zeros((height, width), dtype=CELL_DTYPE))
+        self.changed = None              # cells changed since last Update, None: all
+
+    def MarkChanged(self, cells=None, mask=None):
+        # add changed cells, given as flat indices or as boolean grid,
+        # neither marks all cells:
+        if self.changed is None:
+            return
+        if mask is not None:
+            self.changed |= mask
+        elif cells is not None:
+            self.changed.reshape(-1)[cells] = True
+        else:
+            self.changed = None
+
+    def Update(self, grid):
+        # bring all levels up to date with grid, levels with many dirty
+        # tiles are recomputed in one go:
+        self.levels[0] = grid
+        tiles = None
+        if self.changed is None:
+            self.changed = np.zeros((self.height, self.width), dtype=bool)
+        else:
+            # only bands of DIRTY_TILE rows with changed cells are reduced
+            # to tiles (and cleared):
+            tiles = []
+            band_rows = np.logical_or.reduceat(self.changed.any(axis=1), np.arange(0, self.height, DIRTY_TILE))
+            for row in np.flatnonzero(band_rows):
+                band = self.changed[row * DIRTY_TILE:(row + 1) * DIRTY_TILE]
+                cols = np.logical_or.reduceat(band.any(axis=0), np.arange(0, self.width, DIRTY_TILE))
+                tiles.extend((row, col) for col in np.flatnonzero(cols))
+                band[:] = False
+        if tiles is None or len(tiles) * PYRAMID_RECT_CELLS > grid.size:
+            for level in range(1, len(self.levels)):
+                self.levels[level] = block_majority(self.levels[level - 1])
+        else:
+            rects = set((row * DIRTY_TILE, (row + 1) * DIRTY_TILE, col * DIRTY_TILE,
+                         (col + 1) * DIRTY_TILE) for row, col in tiles)
+            for level in range(1, len(self.levels)):
+                rects = set((row1 // 2, -(-row2 // 2), col1 // 2, -(-col2 // 2)) \
+                            for row1, row2, col1, col2 in rects)
+                below = self.levels[level - 1]
+                if len(rects) * PYRAMID_RECT_CELLS > below.size:
+                    self.levels[level] = block_majority(below)
+                    continue
+                for row1, row2, col1, col2 in rects:
+                    self.levels[level][row1:row2, col1:col2] = \
+                        block_majority(below[2 * row1:2 * row2, 2 * col1:2 * col2])
+
+
+# majority state of each 2x2 block of grid (ties: top left cell), odd sizes
+# are padded by repeating the last row or column:
+def block_majority(grid):
+    if grid.shape[0] % 2 or grid.shape[1] % 2:
+        grid = np.pad(grid, ((0, grid.shape[0] % 2), (0, grid.shape[1] % 2)), "edge")
+    a, b = grid[0::2, 0::2], grid[0::2, 1::2]
+    c, d = grid[1::2, 0::2], grid[1::2, 1::2]
+    return np.where((a == b) | (a == c) | (a == d), a,
+                    np.where((b == c) | (b == d), b, np.where(c == d, c, a)))
+
+
+# Part of the grid shown in the main part of the window: pyramid level,
+# pixels per cell of that level (zoomed in: level 0 with up to MAX_PIXEL_SIZE
+# pixels per cell, zoomed out: one pixel per 2**level x 2**level cells) and
+# top left cell shown:
+class Viewport():
+
+    def __init__(self, cell_size):
+        self.level = 0
+        self.cell_size = cell_size
+        self.row = 0
+        self.col = 0
+
+    def Region(self, height, width):
+        # visible part of a grid of height x width cells: level, pixels per
+        # cell, top left row and column, number of rows and columns (all in
+        # cells of the level):
+        scale = 1 << self.level
+        level_height, level_width = -(-height // scale), -(-width // scale)
+        rows = min(level_height, HEIGHT // self.cell_size)
+        cols = min(level_width, MAIN_WIDTH // self.cell_size)
+        row = max(0, min(self.row // scale, level_height - rows))
+        col = max(0, min(self.col // scale, level_width - cols))
+        return self.level, self.cell_size, row, col, rows, cols
+
+    def Clamp(self, height, width):
+        # keep top left cell within grid:
+        level, cell_size, row, col, rows, cols = self.Region(height, width)
+        self.row, self.col = row << level, col << level
+
+    def Pan(self, rows, cols, height, width):
+        # move by rows and columns in quarters of the visible part:
+        level, cell_size, row, col, view_rows, view_cols = self.Region(height, width)
+        self.row = (row << level) + rows * (view_rows << level) // 4
+        self.col = (col << level) + cols * (view_cols << level) // 4
+        self.Clamp(height, width)
+
+    def Zoom(self, steps, height, width):
+        # zoom in (steps > 0) or out by factors of 2, keeping the centre; a
+        # zoomed-out view stops when the whole grid fits:
+        level, cell_size, row, col, rows, cols = self.Region(height, width)
+        centre_row = ((2 * row + rows) << level) // 2
+        centre_col = ((2 * col + cols) << level) // 2
+        for i in range(abs(steps)):
+            if steps > 0 and self.level > 0:
+                self.level -= 1
+            elif steps > 0:
+                self.cell_size = min(2 * self.cell_size, MAX_PIXEL_SIZE)
+            elif self.cell_size > 1:
+                self.cell_size //= 2
+            elif -(-height >> self.level) > HEIGHT or -(-width >> self.level) > MAIN_WIDTH:
+                self.level += 1
+        level, cell_size, row, col, rows, cols = self.Region(height, width)
+        self.row = centre_row - (rows << level) // 2
+        self.col = centre_col - (cols << level) // 2
+        self.Clamp(height, width)
+
+
+######################################################################
+#
+# Cache for the memo engine: maps a block of MEMO_BLOCK x MEMO_BLOCK cells
+# plus a halo of one cell (as bytes, row by row) to the next state of the
+# block. The least recently used blocks are dropped when more than capacity
+# are stored. Only valid for one number of states and neighbourhood:
+class BlockCache():
+
+    def __init__(self, num_states, neighbourhood, offsets, capacity=MEMO_CACHE_SIZE):
+        self.num_states = num_states
+        self.neighbourhood = neighbourhood
+        self.offsets = offsets
+        self.capacity = capacity
+        self.cache = collections.OrderedDict()
+        self.hits = 0                    # blocks taken from cache or computed earlier in same call
+        self.misses = 0                  # blocks computed
+        self.evictions = 0               # blocks dropped from cache
+
+    def Fits(self, num_states, neighbourhood):
+        return self.num_states == num_states and self.neighbourhood == neighbourhood
+
+    def NextStates(self, windows):
+        # next states of blocks, windows has one row per block with halo;
+        # equal windows are looked up once, returns bytes of all blocks:
+        keys = windows.view(np.dtype((np.void, windows.shape[1]))).ravel()
+        unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        key_bytes = unique.tostring()
+        length = windows.shape[1]
+        results = []
+        missing = []
+        for i in range(len(unique)):
+            key = key_bytes[i * length:(i + 1) * length]
+            result = self.cache.pop(key, None)
+            if result is None:
+                missing.append(i)
+            else:
+                self.cache[key] = result         # now most recently used
+            results.append(result)
+        if missing:
+            computed = self.Compute(windows[first[missing]])
+            block_length = computed.shape[1]
+            computed = computed.tostring()
+            for j, i in enumerate(missing):
+                result = computed[j * block_length:(j + 1) * block_length]
+                self.cache[key_bytes[i * length:(i + 1) * length]] = result
+                results[i] = result
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        blocks = np.frombuffer("".join(results), dtype=CELL_DTYPE).reshape(len(unique), -1)
+        return blocks[inverse]
+
+    def Compute(self, windows):
+        # next states of the blocks in windows (without halo):
+        size = int(round(math.sqrt(windows.shape[1]))) - 2
+        windows = windows.reshape(-1, size + 2, size + 2)
+        block = windows[:, 1:-1, 1:-1]
+        target = (block + 1) % self.num_states
+        mask = np.zeros(block.shape, dtype=bool)
+        for row_off, col_off in self.offsets:
+            mask |= windows[:, 1 + row_off:size + 1 + row_off, 1 + col_off:size + 1 + col_off] == target
+        return np.where(mask, target, block).reshape(len(windows), -1)
+
+    def Statistics(self):
+        # hits, misses, evictions, hit rate and number of cached blocks:
+        total = max(self.hits + self.misses, 1)
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": float(self.hits) / total, "size": len(self.cache)}
+
+
 ######################################################################
 #
 # Cellular Automaton class, stores and evolves states:
 class CellularAutomaton():
 
-    def __init__(self, w, h, num_states, cell_size, random_start=True):
+    def __init__(self, w, h, num_states, cell_size, random_start=True, engine=ENGINE,
+                 workers=WORKERS):
         # initialize cellular automaton with width w, height h and
-        # num_states number of states:
+        # num_states number of states, engine selects the stepping
+        # backend (see ENGINES), workers is only used by the parallel engine:
         self.width = w
         self.height = h
         self.num_states = num_states
         self.cell_size = cell_size
-        self.grid = [[0 for col in range(w)] for row in range(h)]
-        if random_start:
-            self.InitializeRandomly()
-        self.iterations = 0
         self.num_cells = w * h
         self.offsets = {"Moore": [[0, 1], [0, -1], [1, 0], [-1, 0],
                                  [1, 1], [1, -1], [-1, 1], [-1, -1]],
                         "von Neumann": [[0, 1], [0, -1], [1, 0], [-1, 0]]}
+        self.engines = {"active": self.EvolveOneStepActive,
+                        "numpy": self.EvolveOneStepNumpy,
+                        "parallel": self.EvolveOneStepParallel,
+                        "memo": self.EvolveOneStepMemo,
+                        "list": self.EvolveOneStepList}
+        self.workers = workers
+        self.parallel = None
+        self.recorder = None
+        self.hash_history = None         # cycle detection is off
+        self.pyramid = None              # downsampled grids, see GetLevel
+        self.block_cache = None          # memo engine, see BlockCache
+        self.SetEngine(engine)
+        self.initial_grid = np.zeros((h, w), dtype=CELL_DTYPE)
+        self.grid = self.EngineGrid(self.initial_grid)
+        if random_start:
+            self.InitializeRandomly()
+        self.iterations = 0
+        self.drawn_grid = None
+        self.drawn_cell_size = None
+
+    def SetEngine(self, engine):
+        # select stepping backend, the grid is converted to the storage
+        # format of the new engine (NumPy array or list of lists), the
+        # initial grid is always kept as compact NumPy array:
+        if engine not in self.engines:
+            raise ValueError("unknown engine: " + str(engine))
+        self.engine = engine
+        if hasattr(self, "grid"):
+            self.grid = self.EngineGrid(self.grid)
+        self.GridReplaced()
+
+    def GridReplaced(self):
+        # forget per-generation history after the grid has been replaced
+        # (new initial values, reset, loading, change of engine):
+        self.SetChanged()
+        self.active_cells = self.num_cells    # number of cells evaluated in last generation
+        self.last_neighbourhood = None
+        self.min_diff = None             # per-cell MinDist values, see GetEntropy
+        self.entropy_iteration = None    # iteration of cached GetEntropy value
+        if self.hash_history is not None:
+            self.ResetCycleDetection()
+        if self.pyramid is not None:
+            self.pyramid.MarkChanged(None)
+
+    def EngineGrid(self, grid):
+        # convert grid (list of lists or NumPy array) to the storage
+        # format used by the current engine, always returns a copy:
+        if self.engine != "list":
+            return np.array(grid, dtype=CELL_DTYPE)
+        return grid_as_list(grid)
 
     def InitializeRandomly(self, seed=None):
-        # initialize CA with random values:
-        if seed != None:
-            random.seed(seed)
-        self.grid = [[random.randint(0, self.num_states - 1) \
-                      for col in range(self.width)] \
-                     for row in range(self.height)]
-        self.initial_grid = deepcopy(self.grid)
+        # initialize CA with random values, generated in one go:
+        generator = np.random.RandomState(seed)
+        self.initial_grid = generator.randint(0, self.num_states, (self.height, self.width),
+                                              dtype=CELL_DTYPE)
+        self.grid = self.EngineGrid(self.initial_grid)
+        self.GridReplaced()
 
     def ResetGrid(self):
-        # reset CA to last initial values so simulation can be restarted:
+        # reset CA to last initial values so simulation can be restarted,
+        # copies the buffer in place where possible:
         self.iterations = 0
-        self.grid = deepcopy(self.initial_grid)
+        if self.engine != "list" and self.grid.shape == self.initial_grid.shape:
+            np.copyto(self.grid, self.initial_grid)
+        else:
+            self.grid = self.EngineGrid(self.initial_grid)
+        self.GridReplaced()
 
     def GetGrid(self):
         # return CA data (grid):
+        if self.engine != "list":
+            return self.grid.copy()
         return self.grid[:]
 
+    def GetLevel(self, level):
+        # grid (level 0) or downsampled grid of GridPyramid, the pyramid is
+        # created on first use and from then on updated from changed cells,
+        # it is dropped when the view is back at level 0:
+        grid = np.asarray(self.grid, dtype=CELL_DTYPE)
+        if level == 0:
+            self.pyramid = None
+            return grid
+        if self.pyramid is None or (self.pyramid.height, self.pyramid.width) != grid.shape:
+            self.pyramid = GridPyramid(self.height, self.width)
+        self.pyramid.Update(grid)
+        return self.pyramid.levels[min(level, len(self.pyramid.levels) - 1)]
+
     def HasPlusOneNeighbour(self, row, col, neighbourhood):
         # check whether cell at position (row, col) has at least one
         # neighbour in a state one higher (mod N) than the cell in question:
@@ -178,21 +863,327 @@ class CellularAutomaton():
                 return True
         return False
 
+    def PlusOneMask(self, grid, neighbourhood):
+        # whole-grid version of HasPlusOneNeighbour: boolean array which is
+        # True where a cell has at least one neighbour in a state one higher
+        # (mod N), neighbours are found by toroidal shifts of the grid:
+        target = (grid + 1) % self.num_states
+        mask = np.zeros(grid.shape, dtype=bool)
+        for row_off, col_off in self.offsets[neighbourhood]:
+            mask |= np.roll(grid, (-row_off, -col_off), axis=(0, 1)) == target
+        return mask
+
     def EvolveOneStep(self, neighbourhood):
-        # evolve CA one generation:
+        # evolve CA one generation using the selected engine:
+        self.engines[self.engine](neighbourhood)
+        self.last_neighbourhood = neighbourhood
+        self.iterations += 1
+        if self.hash_history is not None:
+            self.UpdateHash()
+        if self.pyramid is not None:
+            self.pyramid.MarkChanged(self.changed_cells, self.changed_mask)
+        if self.recorder is not None:
+            self.recorder.Record(self)
+        return self.iterations
+
+    def StartCycleDetection(self, history=HASH_HISTORY):
+        # keep a rolling hash of the grid and a table of the last history
+        # hashes to detect fixed points and cycles:
+        self.hash_history = history
+        self.ResetCycleDetection()
+
+    def ResetCycleDetection(self):
+        # start new hash table with hash of the current grid:
+        self.hashes = {}                 # grid hash -> last iteration it was seen
+        self.hash_order = collections.deque()
+        self.period = None               # period of detected cycle, 1 is a fixed point
+        self.cycle_start = None          # first iteration found to be in the cycle
+        self.grid_hash = grid_hash(self.grid)
+        self.RecordHash()
+
+    def UpdateHash(self):
+        # update grid hash from the changed cells (their old state is one
+        # less, mod N), without changed cells the whole grid is hashed:
+        cells = self.ChangedCells()
+        if cells is None:
+            self.grid_hash = grid_hash(self.grid)
+        else:
+            new = self.grid.reshape(-1)[cells]
+            old = (new + (self.num_states - 1)) % self.num_states
+            keys = cells.astype(np.uint64) * np.uint64(16)
+            delta = (cell_hash(keys + new) - cell_hash(keys + old)).sum()
+            self.grid_hash = (self.grid_hash + int(delta)) & HASH_MASK
+        self.RecordHash()
+
+    def RecordHash(self):
+        # look up current grid hash in table of recent hashes, a hit means
+        # the grid has been seen before: cycle found:
+        seen = self.hashes.get(self.grid_hash)
+        if seen is not None and self.period is None:
+            self.period = self.iterations - seen
+            self.cycle_start = seen
+        self.hashes[self.grid_hash] = self.iterations
+        self.hash_order.append((self.grid_hash, self.iterations))
+        if len(self.hash_order) > self.hash_history:
+            old_hash, old_iteration = self.hash_order.popleft()
+            if self.hashes.get(old_hash) == old_iteration:
+                del self.hashes[old_hash]
+
+    def JumpTo(self, neighbourhood, target):
+        # advance to iteration target, once a cycle has been detected whole
+        # periods are skipped without computing them:
+        if self.period is not None and target > self.iterations:
+            self.iterations = target - (target - self.iterations) % self.period
+            self.hashes = {}
+            self.hash_order = collections.deque()
+        return self.EvolveSteps(neighbourhood, target - self.iterations)
+
+    def EvolveSteps(self, neighbourhood, steps):
+        # evolve CA several generations in one call. The dense NumPy engines
+        # use temporal blocking: the grid is processed in bands of rows small
+        # enough to stay in the CPU cache, and each band is evolved several
+        # generations before moving on to the next one:
+        done = 0
+        while done < steps:
+            block = min(TEMPORAL_BLOCK_STEPS, steps - done)
+            if self.UseTemporalBlocking(neighbourhood, block):
+                self.EvolveBlock(neighbourhood, block)
+            else:
+                for i in range(block):
+                    self.EvolveOneStep(neighbourhood)
+            done += block
+        return self.iterations
+
+    def UseTemporalBlocking(self, neighbourhood, steps):
+        # temporal blocking pays off for several generations of a dense
+        # sweep on a grid larger than one band, recording and cycle
+        # detection need every single generation:
+        band_rows = TEMPORAL_BLOCK_CELLS // self.width
+        if steps < 2 or self.recorder is not None or self.hash_history is not None or \
+           band_rows < 4 * steps or \
+           band_rows >= self.height:
+            return False
+        if self.engine == "numpy":
+            return True
+        return self.engine == "active" and not self.SparseStep(neighbourhood)
+
+    def EvolveBlock(self, neighbourhood, steps):
+        # evolve each band together with a halo of steps rows above and below
+        # (wrapping around) for steps generations, errors from the band edges
+        # move inwards by one row per generation so the inner rows are exact:
+        band_rows = TEMPORAL_BLOCK_CELLS // self.width
+        grid = np.empty_like(self.grid)
+        changed = np.zeros(self.grid.shape, dtype=bool)
+        # the pyramid needs the cells changed in any of the generations:
+        changed_any = np.zeros(self.grid.shape, dtype=bool) if self.pyramid is not None else None
+        for row1 in range(0, self.height, band_rows):
+            row2 = min(row1 + band_rows, self.height)
+            band = self.grid[np.arange(row1 - steps, row2 + steps) % self.height]
+            band_changed = np.zeros(band.shape, dtype=bool)
+            for i in range(steps):
+                mask = self.PlusOneMask(band, neighbourhood)
+                band = np.where(mask, (band + 1) % self.num_states, band)
+                band_changed |= mask
+            grid[row1:row2] = band[steps:-steps]
+            changed[row1:row2] = mask[steps:-steps]
+            if changed_any is not None:
+                changed_any[row1:row2] = band_changed[steps:-steps]
+        if changed_any is not None:
+            self.pyramid.MarkChanged(mask=changed_any)
+        self.grid = grid
+        self.SetChanged(mask=changed)
+        self.active_cells = self.num_cells
+        self.last_neighbourhood = neighbourhood
+        self.iterations += steps
+
+    def StartRecording(self, filename, neighbourhood, keyframe_interval=KEYFRAME_INTERVAL):
+        # stream all following generations to a trajectory file:
+        self.StopRecording()
+        self.recorder = TrajectoryRecorder(filename, self, neighbourhood, keyframe_interval)
+        return filename
+
+    def StopRecording(self):
+        # finish writing the trajectory file, if any:
+        if self.recorder is not None:
+            self.recorder.Close()
+            self.recorder = None
+
+    def EvolveOneStepList(self, neighbourhood):
+        # reference engine, cell by cell on list of lists:
         self.grid = [[self.grid[row][col] if not self.HasPlusOneNeighbour(row, col, neighbourhood) \
                      else (self.grid[row][col] + 1) % self.num_states \
                      for col in range(self.width)] for row in range(self.height)]
-        self.iterations += 1
-        return self.iterations
+        self.SetChanged()
+        self.active_cells = self.num_cells
+
+    def EvolveOneStepNumpy(self, neighbourhood):
+        # vectorized engine, whole-array operations on NumPy grid:
+        mask = self.PlusOneMask(self.grid, neighbourhood)
+        self.grid = np.where(mask, (self.grid + 1) % self.num_states, self.grid)
+        self.SetChanged(mask=mask)
+        self.active_cells = self.num_cells
+
+    def EvolveOneStepActive(self, neighbourhood):
+        # sparse engine: a cell can only change if it or one of its
+        # neighbours changed in the last generation, so only these active
+        # cells are evaluated. Falls back to the dense NumPy engine if
+        # there is no history or too many cells may be active:
+        if self.last_neighbourhood != neighbourhood or \
+           not self.SparseStep(neighbourhood):
+            self.EvolveOneStepNumpy(neighbourhood)
+            return
+        active = self.ActiveCells(self.ChangedCells(), neighbourhood)
+        flat = self.grid.reshape(-1)
+        rows, cols = np.divmod(active, self.width)
+        target = (flat[active] + 1) % self.num_states
+        has_plus_one = np.zeros(len(active), dtype=bool)
+        for row_off, col_off in self.offsets[neighbourhood]:
+            has_plus_one |= flat[self.FlatNeighbours(rows, cols, row_off, col_off)] == target
+        self.SetChanged(active[has_plus_one])
+        flat[self.changed_cells] = target[has_plus_one]
+        self.active_cells = len(active)
+
+    def EvolveOneStepParallel(self, neighbourhood):
+        # multi-core engine, horizontal strips of the grid are evolved by
+        # worker processes in shared memory (see ParallelStepper):
+        if self.parallel is None or not self.parallel.Fits(self):
+            self.StopWorkers()
+            self.parallel = ParallelStepper(self.width, self.height, self.num_states,
+                                            self.offsets, self.workers)
+        self.grid = self.parallel.Step(self.grid, neighbourhood)
+        self.SetChanged(mask=self.parallel.changed)
+        self.active_cells = self.num_cells
+
+    def EvolveOneStepMemo(self, neighbourhood):
+        # memoizing engine: the next state of a block of MEMO_BLOCK x
+        # MEMO_BLOCK cells only depends on the block and a halo of one cell,
+        # so blocks seen before are taken from a BlockCache. Blocks at the
+        # right and bottom edges may extend beyond the grid, these cells
+        # (wrapped around) are computed but not used:
+        if self.block_cache is None or not self.block_cache.Fits(self.num_states, neighbourhood):
+            self.block_cache = BlockCache(self.num_states, neighbourhood, self.offsets[neighbourhood])
+        size = MEMO_BLOCK
+        block_rows = -(-self.height // size)
+        block_cols = -(-self.width // size)
+        rows = np.arange(-1, block_rows * size + 1) % self.height
+        cols = np.arange(-1, block_cols * size + 1) % self.width
+        extended = self.grid[rows[:, None], cols]
+        row_stride, col_stride = extended.strides
+        windows = np.lib.stride_tricks.as_strided(extended, (block_rows, block_cols, size + 2, size + 2),
+                                                  (size * row_stride, size * col_stride,
+                                                   row_stride, col_stride))
+        windows = np.ascontiguousarray(windows.reshape(block_rows * block_cols, -1))
+        blocks = self.block_cache.NextStates(windows)
+        grid = blocks.reshape(block_rows, block_cols, size, size).transpose(0, 2, 1, 3)
+        grid = np.ascontiguousarray(grid.reshape(block_rows * size, block_cols * size)[:self.height, :self.width])
+        self.SetChanged(mask=grid != self.grid)
+        self.grid = grid
+        self.active_cells = self.num_cells
+
+    def StopWorkers(self):
+        # terminate worker processes of the parallel engine, if any:
+        if self.parallel is not None:
+            self.parallel.Stop()
+            self.parallel = None
+
+    def SetChanged(self, cells=None, mask=None):
+        # remember the cells changed in the last generation: flat indices
+        # after sparse steps, a boolean grid (one byte per cell instead of
+        # eight) after dense steps, neither if unknown:
+        self.changed_cells = cells
+        self.changed_mask = mask
+
+    def ChangedCells(self):
+        # flat indices of the cells changed in the last generation, None if
+        # unknown, a boolean grid is converted on demand:
+        if self.changed_mask is not None:
+            return np.flatnonzero(self.changed_mask)
+        return self.changed_cells
+
+    def ChangedCount(self):
+        # number of cells changed in the last generation, None if unknown:
+        if self.changed_mask is not None:
+            return int(np.count_nonzero(self.changed_mask))
+        return None if self.changed_cells is None else len(self.changed_cells)
+
+    def SparseStep(self, neighbourhood):
+        # the active set of the changed cells has at most ChangedCount times
+        # the neighbourhood size plus one entries, checked against
+        # ACTIVE_DENSE_FRACTION before it is built:
+        count = self.ChangedCount()
+        return count is not None and \
+               count * (len(self.offsets[neighbourhood]) + 1) <= ACTIVE_DENSE_FRACTION * self.num_cells
+
+    def ActiveCells(self, cells, neighbourhood):
+        # flat indices of the given cells and all their neighbours:
+        active = np.zeros(self.num_cells, dtype=bool)
+        active[cells] = True
+        rows, cols = np.divmod(cells, self.width)
+        for row_off, col_off in self.offsets[neighbourhood]:
+            active[self.FlatNeighbours(rows, cols, row_off, col_off)] = True
+        return np.flatnonzero(active)
+
+    def FlatNeighbours(self, rows, cols, row_off, col_off):
+        # flat indices of the neighbours at offset (row_off, col_off) of the
+        # cells at positions (rows, cols), wrapping around:
+        return ((rows + row_off) % self.height) * self.width + (cols + col_off) % self.width
         
-    def DrawCells(self, surface):
-        # draw CA on screen:
-        for row in range(self.height):
-            for col in range(self.width):
-                color = PALETTE[self.grid[row][col]]
-                surface.fill(color, (col*self.cell_size, HEADER_HEIGHT + row*self.cell_size, self.cell_size, self.cell_size), 0)
-        return surface
+    def DrawCells(self, surface, full=False, grid=None, cell_size=None):
+        # draw CA (or grid, the visible part of it published by the simulation
+        # thread, with cell_size pixels per cell) on screen, only tiles
+        # containing cells changed since the last call are repainted
+        # (everything if full is True), returns the list of repainted
+        # rectangles for pygame.display.update:
+        grid = np.asarray(self.grid if grid is None else grid)
+        cell_size = cell_size or self.cell_size
+        height, width = grid.shape
+        if full or self.drawn_grid is None or self.drawn_grid.shape != grid.shape or \
+           self.drawn_cell_size != cell_size:
+            surface.fill(COLORS["GREY2"], (0, HEADER_HEIGHT, MAIN_WIDTH, HEIGHT))
+            self.BlitCells(surface, grid, 0, height, 0, width, cell_size)
+            self.drawn_grid = grid.copy()
+            self.drawn_cell_size = cell_size
+            return [pygame.Rect(0, HEADER_HEIGHT, MAIN_WIDTH, HEIGHT)]
+        tile_rows = -(-height // DIRTY_TILE)
+        tile_cols = -(-width // DIRTY_TILE)
+        changed = np.zeros((tile_rows * DIRTY_TILE, tile_cols * DIRTY_TILE), dtype=bool)
+        changed[:height, :width] = grid != self.drawn_grid
+        dirty = changed.reshape(tile_rows, DIRTY_TILE, tile_cols, DIRTY_TILE).any(axis=(1, 3))
+        np.copyto(self.drawn_grid, grid)
+        rects = []
+        for tile_row in range(tile_rows):
+            row1 = tile_row * DIRTY_TILE
+            row2 = min(row1 + DIRTY_TILE, height)
+            # merge runs of neighbouring dirty tiles into one rectangle:
+            run_start = None
+            for tile_col in range(tile_cols + 1):
+                is_dirty = tile_col < tile_cols and dirty[tile_row, tile_col]
+                if is_dirty and run_start == None:
+                    run_start = tile_col
+                elif not is_dirty and run_start != None:
+                    rects.append(self.BlitCells(surface, grid, row1, row2, run_start * DIRTY_TILE,
+                                                min(tile_col * DIRTY_TILE, width), cell_size))
+                    run_start = None
+        return rects
+
+    def InvalidateCells(self, rect):
+        # make the next DrawCells call repaint the cells within the screen
+        # rectangle rect (e.g. after something was drawn on top of them):
+        if self.drawn_grid is not None:
+            row1 = max(0, (rect.top - HEADER_HEIGHT) // self.drawn_cell_size)
+            col1 = max(0, rect.left // self.drawn_cell_size)
+            row2 = (rect.bottom - HEADER_HEIGHT) // self.drawn_cell_size + 1
+            col2 = rect.right // self.drawn_cell_size + 1
+            self.drawn_grid[row1:row2, col1:col2] = 255
+
+    def BlitCells(self, surface, grid, row1, row2, col1, col2, cell_size):
+        # map states of cells in rows row1 to row2 and columns col1 to col2
+        # to colours, scale by cell_size and copy to surface in one go:
+        rgb = PALETTE_RGB[grid[row1:row2, col1:col2]]
+        if cell_size > 1:
+            rgb = rgb.repeat(cell_size, axis=0).repeat(cell_size, axis=1)
+        block = pygame.surfarray.make_surface(rgb.transpose(1, 0, 2))
+        return surface.blit(block, (col1 * cell_size, HEADER_HEIGHT + row1 * cell_size))
 
     def SaveImage(self, surface):
         # save current graphics output as PNG image file:
@@ -204,282 +1195,1201 @@ class CellularAutomaton():
         # calculate minimum difference in states between cell at position
         # (row, col) and it's neighbours
         min_diff = 10 * self.num_states
-        offsets = {"Moore": [[0, 1], [0, -1], [1, 0], [-1, 0],
-                             [1, 1], [1, -1], [-1, 1], [-1, -1]],
-                   "von Neumann": [[0, 1], [0, -1], [1, 0], [-1, 0]]}
-        this_state = self.grid[row][col]
-        for row_off, col_off in offsets[neighbourhood]:
+        this_state = int(self.grid[row][col])
+        for row_off, col_off in self.offsets[neighbourhood]:
             row2 = (row + row_off) % self.height
             col2 = (col + col_off) % self.width
-            other_state = self.grid[row2][col2]
+            other_state = int(self.grid[row2][col2])
             min_diff = min(min_diff, abs((this_state - other_state) % self.num_states), \
                            abs((other_state - this_state) % self.num_states))
         return min_diff
 
+    def MinDiffGrid(self, grid, neighbourhood):
+        # whole-grid version of GetMinDiff, neighbours are found by
+        # toroidal shifts of the grid:
+        n = self.num_states
+        min_diff = np.full(grid.shape, n, dtype=CELL_DTYPE)
+        for row_off, col_off in self.offsets[neighbourhood]:
+            diff = (grid + n - np.roll(grid, (-row_off, -col_off), axis=(0, 1))) % n
+            np.minimum(min_diff, np.minimum(diff, n - diff), out=min_diff)
+        return min_diff
+
+    def MinDiffCells(self, grid, cells, neighbourhood):
+        # GetMinDiff for the cells with the given flat indices:
+        n = self.num_states
+        flat = grid.reshape(-1)
+        rows, cols = np.divmod(cells, self.width)
+        states = flat[cells]
+        min_diff = np.full(len(cells), n, dtype=CELL_DTYPE)
+        for row_off, col_off in self.offsets[neighbourhood]:
+            diff = (states + n - flat[self.FlatNeighbours(rows, cols, row_off, col_off)]) % n
+            np.minimum(min_diff, np.minimum(diff, n - diff), out=min_diff)
+        return min_diff
+
     def GetEntropy(self, neighbourhood):
-        # calculate average MinDist value over all cells:
-        ent = 0
-        for row in range(self.height):
-            for col in range(self.width):
-                ent += self.GetMinDiff(row, col, neighbourhood)
-        return float(ent) / self.num_cells
-
-    def SaveInitial(self, neighbourhood):
-        # save initial configuration to pickle file:
-        filename = get_filename("SpirallingCells_initial_", self.num_states, \
-                                self.cell_size, self.width, self.height, "p")
-        f = open(filename, "wb")
-        pickle.dump(self.num_states, f)
-        pickle.dump(self.width, f)
-        pickle.dump(self.height, f)
-        pickle.dump(self.cell_size, f)
-        pickle.dump(neighbourhood, f)
-        pickle.dump(self.initial_grid, f)
-        pickle.dump(0, f)
-        f.close()
-        return filename
+        # calculate average MinDist value over all cells. The value is cached
+        # per iteration, if the last value is from the previous generation
+        # only the changed cells and their neighbours are recomputed:
+        if self.entropy_iteration == self.iterations and self.entropy_neighbourhood == neighbourhood:
+            return self.entropy
+        grid = np.asarray(self.grid, dtype=CELL_DTYPE)
+        if self.min_diff is not None and self.entropy_iteration == self.iterations - 1 and \
+           self.entropy_neighbourhood == neighbourhood and self.SparseStep(neighbourhood):
+            cells = self.ActiveCells(self.ChangedCells(), neighbourhood)
+            new_diff = self.MinDiffCells(grid, cells, neighbourhood)
+            flat = self.min_diff.reshape(-1)
+            self.min_diff_sum += int(new_diff.sum(dtype=np.int64)) - int(flat[cells].sum(dtype=np.int64))
+            flat[cells] = new_diff
+        else:
+            self.min_diff = self.MinDiffGrid(grid, neighbourhood)
+            self.min_diff_sum = int(self.min_diff.sum(dtype=np.int64))
+        self.entropy_iteration = self.iterations
+        self.entropy_neighbourhood = neighbourhood
+        self.entropy = float(self.min_diff_sum) / self.num_cells
+        return self.entropy
 
-    def SaveCurrent(self, neighbourhood):
-        # save current configuration to pickle file:
-        filename = get_filename("SpirallingCells_current_", self.num_states, \
-                                self.cell_size, self.width, self.height, "p")
-        f = open(filename, "wb")
-        pickle.dump(self.num_states, f)
-        pickle.dump(self.width, f)
-        pickle.dump(self.height, f)
-        pickle.dump(self.cell_size, f)
-        pickle.dump(neighbourhood, f)
-        pickle.dump(self.grid, f)
-        pickle.dump(self.iterations, f)
-        f.close()
-        return filename
+    def EstimateEntropy(self, neighbourhood, max_error=ENTROPY_MAX_ERROR, seed=None):
+        # estimate average MinDist value from randomly sampled cells for huge
+        # grids, cells are sampled until the 95% confidence interval is
+        # within +- max_error, returns estimate and half-width of interval:
+        if self.num_cells <= ENTROPY_SAMPLE_BATCH:
+            return self.GetEntropy(neighbourhood), 0.0
+        generator = np.random.RandomState(seed)
+        grid = np.asarray(self.grid, dtype=CELL_DTYPE)
+        total = total_squares = 0.0
+        count = 0
+        while count < self.num_cells:
+            cells = generator.randint(0, self.num_cells, ENTROPY_SAMPLE_BATCH)
+            min_diff = self.MinDiffCells(grid, cells, neighbourhood).astype(np.float64)
+            total += min_diff.sum()
+            total_squares += (min_diff * min_diff).sum()
+            count += len(cells)
+            mean = total / count
+            error = 1.96 * math.sqrt(max(total_squares / count - mean * mean, 0.0) / count)
+            if error <= max_error:
+                break
+        return mean, error
 
-    def LoadState(self):
-        # load configuration from pickle file, filename is chosen via
-        # an "askopenfilename" dialog in tkinter:
-        tk_root = Tk()
-        file_path = tkFileDialog.askopenfilename()
-        f = open(file_path, "rb")
-        self.num_states = pickle.load(f)
-        self.width = pickle.load(f)
-        self.height = pickle.load(f)
-        self.cell_size = pickle.load(f)
-        neighbourhood = pickle.load(f)
-        self.grid = pickle.load(f)
-        self.iterations = pickle.load(f)
-        f.close()
-        tk_root.destroy()
-        return neighbourhood
+    def SaveInitial(self, neighbourhood, filename=None, compress=False):
+        # save initial configuration to snapshot file:
+        if filename == None:
+            filename = get_filename("SpirallingCells_initial_", self.num_states, \
+                                    self.cell_size, self.width, self.height, "cells")
+        return save_snapshot(filename, self.initial_grid, self.num_states, self.cell_size,
+                             neighbourhood, 0, compress)
+
+    def SaveCurrent(self, neighbourhood, filename=None, compress=False):
+        # save current configuration to snapshot file:
+        if filename == None:
+            filename = get_filename("SpirallingCells_current_", self.num_states, \
+                                    self.cell_size, self.width, self.height, "cells")
+        return save_snapshot(filename, self.grid, self.num_states, self.cell_size,
+                             neighbourhood, self.iterations, compress)
+
+    def LoadFile(self, file_path):
+        # load configuration from snapshot file (or pickle file written by
+        # earlier versions), returns neighbourhood:
+        if is_snapshot(file_path):
+            state = load_snapshot(file_path)
+        else:
+            state = load_pickle_state(file_path)
+        self.num_states = state["num_states"]
+        self.width = state["width"]
+        self.height = state["height"]
+        self.cell_size = state["cell_size"]
+        # the memory-mapped grid is used directly, it is copy-on-write. The
+        # loaded state becomes the initial grid for restarting, as a second
+        # mapping of its own (pages are still read on demand) so in-place
+        # changes of the grid never reach it:
+        grid = state["grid"]
+        if isinstance(grid, np.memmap):
+            self.initial_grid = np.memmap(grid.filename, dtype=CELL_DTYPE, mode="c",
+                                          offset=grid.offset, shape=grid.shape)
+        else:
+            self.initial_grid = grid.copy()
+        self.grid = self.EngineGrid(grid) if self.engine == "list" else grid
+        self.iterations = state["iteration"]
+        self.num_cells = self.width * self.height
+        self.GridReplaced()
+        return state["neighbourhood"]
 
 
         
+######################################################################
+#
+# Simulation thread for the interactive mode: the thread owns the CA and
+# evolves it while the main loop handles events and draws. Commands
+# (see Apply) are passed through a queue and handled between chunks of a few
+# generations. The visible part of finished generations (see Viewport) is
+# copied to a back buffer which is swapped with the front buffer, the main
+# loop takes the front buffer with Latest. A frame not taken before the next
+# one is published is dropped. The NumPy engines release the GIL while
+# computing, so the main loop stays responsive:
+class SimulationThread():
+
+    def __init__(self, CA, neighbourhood, steps, viewport, running=True, show_mindist=False):
+        # steps is the number of generations per published frame, 0 = auto:
+        self.CA = CA
+        self.viewport = viewport
+        self.neighbourhood = neighbourhood
+        self.steps = steps
+        self.running = running
+        self.show_mindist = show_mindist
+        self.auto_steps = 1              # generations per frame in auto mode, adapted each frame
+        self.commands = Queue.Queue()
+        self.ready = threading.Condition()
+        self.back = None                 # buffer written by simulation thread
+        self.front = None                # last published frame, None if taken
+        self.generations = 0             # generations since last frame was taken
+        self.dropped = 0                 # number of frames never taken
+        self.error = None                # exception info if the thread failed, see CheckError
+        self.spans = []                  # timed SIMULATION_PHASES since last frame was taken
+        self.new_spans = []              # spans not yet published, simulation thread only
+        self.profiler = None             # cProfile capture of simulation thread, see Apply
+        self.Publish(0)
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Send(self, command, value=None):
+        self.commands.put((command, value))
+
+    def Call(self, method, *args):
+        # call method of CA in simulation thread, waits for the result:
+        replies = Queue.Queue()
+        self.Send("call", (method, args, replies))
+        result, error = self.Wait(replies)
+        if error is not None:
+            raise error
+        return result
+
+    def Wait(self, replies):
+        # wait for reply from simulation thread, raises its exception if it
+        # fails before replying:
+        while True:
+            try:
+                return replies.get(timeout=1.0 / TARGET_FPS)
+            except Queue.Empty:
+                self.CheckError()
+
+    def CheckError(self):
+        # re-raise exception of the simulation thread in the calling thread,
+        # with the original traceback:
+        if self.error is not None:
+            error_type, error, trace = self.error
+            raise error_type, error, trace
+
+    def StartProfile(self):
+        self.Send("profile")
+
+    def StopProfile(self):
+        # stop cProfile capture of the simulation thread, returns the profiler:
+        replies = Queue.Queue()
+        self.Send("profile", replies)
+        return self.Wait(replies)
+
+    def Stop(self):
+        self.Send("stop")
+        self.thread.join()
+
+    def Run(self):
+        # apply commands, evolve and publish until "stop" is received, while
+        # paused only wait for commands. An exception ends the thread, it is
+        # kept for CheckError:
+        try:
+            while True:
+                if not self.running or not self.commands.empty():
+                    command, value = self.commands.get()
+                    if command == "stop":
+                        break
+                    self.Apply(command, value)
+                    if self.commands.empty():
+                        self.Publish(0)
+                else:
+                    generations = self.Evolve()
+                    if generations:
+                        self.Publish(generations)
+        except Exception:
+            self.error = sys.exc_info()
+            if VERBOSE: print "Simulation thread failed:", self.error[1]
+            self.ready.acquire()
+            self.ready.notify()
+            self.ready.release()
+
+    def Apply(self, command, value):
+        if command == "running":
+            self.running = value
+        elif command == "automaton":
+            self.CA = value
+            self.auto_steps = 1
+        elif command == "restart":
+            self.CA.ResetGrid()
+        elif command == "neighbourhood":
+            self.neighbourhood = value
+        elif command == "steps":
+            self.steps = value
+        elif command == "min_dist":
+            self.show_mindist = value
+        elif command == "viewport":
+            self.viewport = value
+        elif command == "call":
+            method, args, replies = value
+            try:
+                replies.put((getattr(self.CA, method)(*args), None))
+            except Exception as error:
+                replies.put((None, error))
+        elif command == "profile":
+            # cProfile only sees the thread it is enabled in. Without reply
+            # queue a capture is started, else it is stopped and returned:
+            if value is None:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            else:
+                if self.profiler is not None:
+                    self.profiler.disable()
+                value.put(self.profiler)
+                self.profiler = None
+        else:
+            raise ValueError("unknown command: " + str(command))
+
+    def Evolve(self):
+        # evolve steps generations in chunks, stops early if a command is
+        # waiting. In auto mode the number of generations per frame is
+        # adapted so the frame rate stays near TARGET_FPS:
+        steps = self.steps or self.auto_steps
+        start = timeit.default_timer()
+        done = 0
+        while done < steps and self.commands.empty():
+            chunk = min(TEMPORAL_BLOCK_STEPS, steps - done)
+            self.CA.EvolveSteps(self.neighbourhood, chunk)
+            done += chunk
+        sim_time = max(timeit.default_timer() - start, 1e-6)
+        self.new_spans.append(("evolve", start, sim_time))
+        if self.steps == 0 and done:
+            self.auto_steps = max(1, min(2 * self.auto_steps, int(done / (sim_time * TARGET_FPS))))
+        return done
+
+    def Publish(self, generations):
+        # copy visible part of grid (from the pyramid level of the viewport)
+        # to back buffer and swap it with the front buffer, an untaken front
+        # buffer is reused as next back buffer. Min Dist is computed here as
+        # it needs the CA:
+        self.ready.acquire()
+        back, self.back = self.back, None
+        self.ready.release()
+        level, cell_size, row, col, rows, cols = self.viewport.Region(self.CA.height, self.CA.width)
+        grid = self.CA.GetLevel(level)[row:row + rows, col:col + cols]
+        if back is None or back["grid"].shape != grid.shape:
+            back = {"grid": np.empty_like(grid)}
+        np.copyto(back["grid"], grid)
+        start = timeit.default_timer()
+        back.update(CA=self.CA, iteration=self.CA.iterations, view=(level, cell_size, row, col),
+                    entropy=self.CA.GetEntropy(self.neighbourhood) if self.show_mindist else None)
+        if self.show_mindist:
+            self.new_spans.append(("entropy", start, timeit.default_timer() - start))
+        self.ready.acquire()
+        if self.front is not None:
+            self.dropped += 1
+            self.back = self.front
+        self.front = back
+        self.generations += generations
+        self.spans.extend(self.new_spans)
+        self.new_spans = []
+        self.ready.notify()
+        self.ready.release()
+
+    def Latest(self, timeout, frame=None):
+        # take newest frame, waits at most timeout seconds for it, returns
+        # None if there is none. frame (the previous result) is no longer
+        # used by the caller and becomes the new back buffer. Raises the
+        # exception of a failed simulation thread:
+        self.ready.acquire()
+        if self.front is None and self.error is None:
+            self.ready.wait(timeout)
+        latest = self.front
+        if latest is not None:
+            latest["generations"] = self.generations
+            latest["spans"] = self.spans
+            self.generations = 0
+            self.spans = []
+            self.front = None
+            if self.back is None:
+                self.back = frame
+        self.ready.release()
+        self.CheckError()
+        return latest
+
+
 ######################################################################
 #
 # PyGame main loop:
 def main_loop(surface):
-    global neighbourhood, num_states, iteration, cell_size, running, show_mindist
+    global neighbourhood, num_states, iteration, cell_size, running, show_mindist, gens_per_frame
 
-    # create cellular automaton instance:
-    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
+    # create cellular automaton instance, it is evolved by the simulation thread:
+    CA = CellularAutomaton(grid_width or MAIN_WIDTH // cell_size, grid_height or HEIGHT // cell_size,
+                           num_states, cell_size)
+    viewport = Viewport(cell_size)   # visible part of grid
+    simulation = SimulationThread(CA, neighbourhood, gens_per_frame, copy.copy(viewport),
+                                  running, show_mindist)
     
     # build control section:
-    button_start = Button(70, 30, "Start", COLORS["GREEN"], COLORS["BLACK"])
-    button_pause = Button(70, 30, "Pause", COLORS["LIGHTRED"], COLORS["BLACK"])
-    button_continue = Button(70, 30, "Continue", COLORS["GREEN"], COLORS["BLACK"])
-    button_restart = Button(70, 30, "Restart", COLORS["GREEN"], COLORS["BLACK"])
-    button_quit = Button(70, 30, "Quit", COLORS["RED"], COLORS["BLACK"])
-    button_neighbourhood_neumann = Button(90, 30, "Neumann", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_neighbourhood_moore = Button(90, 30, "Moore", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_ncell_4 = Button(70, 30, "4", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_ncell_8 = Button(70, 30, "8", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_ncell_12 = Button(70, 30, "12", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_ncell_16 = Button(70, 30, "16", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_save_current = Button(70, 30, "current", COLORS["LIGHTYELLOW"], COLORS["BLACK"])
-    button_save_initial = Button(70, 30, "initial", COLORS["LIGHTYELLOW"], COLORS["BLACK"])
-    button_save_image = Button(70, 30, "image", COLORS["LIGHTYELLOW"], COLORS["BLACK"])
-    button_load_current = Button(70, 30, "load", COLORS["LIGHTYELLOW"], COLORS["BLACK"])
-    button_cell_size1 = Button(70, 30, "1", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_cell_size2 = Button(70, 30, "2", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_cell_size3 = Button(70, 30, "3", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_cell_size4 = Button(70, 30, "4", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-    button_toggle_entropy = Button(120, 30, "switch off", COLORS["LIGHTBLUE"], COLORS["BLACK"])
-
-    last_grid = CA.GetGrid()
+    panel = ControlPanel()
+    timer = FrameTimer()             # per-phase timing of frames
+    show_overlay = False             # show timing overlay, toggled with key "o"
+    profiler = None                  # cProfile capture, started with key "p"
+    frame = None                     # generation currently shown, see SimulationThread.Latest
+    drawn_CA = None                  # CA instance currently shown on screen
+    drawn_view = None                # part of grid currently shown on screen
+    redraw_all = True                # redraw whole window in next frame
     
     while True:
         # loop until user event triggers some action:
 
-        # draw window and title:
-        surface.fill(COLORS["GREY2"])
-        surface.fill(COLORS["LIGHTYELLOW"], (0, 0, MAIN_WIDTH + MENU_WIDTH, HEADER_HEIGHT), 0)
-        draw_text(surface, helv24, "SpirallingCells " + VERSION + \
-                  " ==> https://github.com/RandyWaterhouse/SpirallingCells", (10, 10), COLORS["BLUE"])
-        draw_text(surface, helv24, "by Dr. Peter U.", (MAIN_WIDTH + 25, 10), COLORS["BLUE"])
-
-        # place buttons in control section on right-hand side:
-        button_start.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 30)
-        button_pause.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 30)
-        button_continue.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 70)
-        button_restart.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 70)
-        button_quit.PlaceButton(surface, MAIN_WIDTH + 55, HEADER_HEIGHT + 110)
-        button_neighbourhood_neumann.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 230)
-        button_neighbourhood_moore.PlaceButton(surface, MAIN_WIDTH + 105, HEADER_HEIGHT + 230)
-        button_ncell_4.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 320)
-        button_ncell_8.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 320)
-        button_ncell_12.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 360)
-        button_ncell_16.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 360)
-        button_save_current.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 440)
-        button_save_initial.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 440)
-        button_save_image.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 480)
-        button_load_current.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 480)
-        button_cell_size1.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 560)
-        button_cell_size2.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 560)
-        button_cell_size3.PlaceButton(surface, MAIN_WIDTH + 10, HEADER_HEIGHT + 600)
-        button_cell_size4.PlaceButton(surface, MAIN_WIDTH + 100, HEADER_HEIGHT + 600)
-        button_toggle_entropy.PlaceButton(surface, MAIN_WIDTH + 40, HEADER_HEIGHT + 720)
-        
-        # draw text and lines:
-        draw_text(surface, helv24, "Controls:", (MAIN_WIDTH + 45, HEADER_HEIGHT + 0), COLORS["BLACK"])
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 0), (MAIN_WIDTH, HEIGHT), 2)
-        #pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 0), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 0), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 150), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 150), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 270), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 270), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 400), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 400), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 520), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 520), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 640), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 640), 2)
-        pygame.draw.line(surface, COLORS["GREY1"], (MAIN_WIDTH, HEADER_HEIGHT + 680), (MAIN_WIDTH+MENU_WIDTH, HEADER_HEIGHT + 680), 2)
-        draw_text(surface, helv24, "Neighbourhood:", (MAIN_WIDTH + 15, HEADER_HEIGHT + 160), COLORS["BLACK"])
-        draw_text(surface, helv24, neighbourhood, (MAIN_WIDTH + 20, HEADER_HEIGHT + 190), COLORS["BLUE"])
-        draw_text(surface, helv24, "No of states:", (MAIN_WIDTH + 15, HEADER_HEIGHT + 280), COLORS["BLACK"])
-        draw_text(surface, helv24, str(num_states), (MAIN_WIDTH + 160, HEADER_HEIGHT + 280), COLORS["BLUE"])
-        draw_text(surface, helv24, "Save options:", (MAIN_WIDTH + 25, HEADER_HEIGHT + 410), COLORS["BLACK"])
-        draw_text(surface, helv24, "Cell size:", (MAIN_WIDTH + 25, HEADER_HEIGHT + 530), COLORS["BLACK"])
-        draw_text(surface, helv24, str(cell_size), (MAIN_WIDTH + 160, HEADER_HEIGHT + 530), COLORS["BLUE"])
-        draw_text(surface, helv24, "Iteration:", (MAIN_WIDTH + 15, HEADER_HEIGHT + 650), COLORS["BLACK"])
-        draw_text(surface, helv24, str(iteration), (MAIN_WIDTH + 120, HEADER_HEIGHT + 650), COLORS["BLUE"])
-        draw_text(surface, helv24, "Min Dist:", (MAIN_WIDTH + 15, HEADER_HEIGHT + 690), COLORS["BLACK"])
-        entropy_text = str(round(CA.GetEntropy(neighbourhood), 3)) if show_mindist else "---"
-        draw_text(surface, helv24, entropy_text, (MAIN_WIDTH + 120, HEADER_HEIGHT + 690), COLORS["BLUE"])
-
-        # evolve cellular automaton:
-        if running:
-            iteration = CA.EvolveOneStep(neighbourhood)
+        # take newest generation from simulation thread, waits at most one
+        # frame at TARGET_FPS so events are handled in time:
+        generations = 0
+        spans = ()
+        latest = simulation.Latest(1.0 / TARGET_FPS, frame)
+        if latest is not None:
+            frame = latest
+            iteration = frame["iteration"]
+            generations = frame["generations"]
+            spans = frame["spans"]
+        timer.Mark("wait")
+
+        # update texts in control section, only changed parts are redrawn:
+        panel.SetField("neighbourhood", neighbourhood)
+        panel.SetField("num_states", str(num_states))
+        panel.SetField("cell_size", str(cell_size))
+        panel.SetField("iteration", str(iteration))
+        entropy_text = str(round(frame["entropy"], 3)) if frame["entropy"] is not None else "---"
+        panel.SetField("min_dist", entropy_text)
+        panel.SetField("gens_per_frame", (str(gens_per_frame) if gens_per_frame else "auto") + " gen/fr")
+        panel_rects = panel.Draw(surface, full=redraw_all)
+        timer.Mark("ui")
  
-        # draw cells in main part of window:
-        CA.DrawCells(surface)
-        pygame.display.flip()
+        # draw cells in main part of window, only changed parts of the
+        # screen are updated:
+        shown_CA = frame["CA"]
+        cell_rects = shown_CA.DrawCells(surface, full=redraw_all or shown_CA is not drawn_CA or \
+                                        frame["view"] != drawn_view,
+                                        grid=frame["grid"], cell_size=frame["view"][1])
+        drawn_CA = shown_CA
+        drawn_view = frame["view"]
+        redraw_all = False
+        if show_overlay:
+            overlay_rect = timer.DrawOverlay(surface, get_font("Helvetica", 20))
+            shown_CA.InvalidateCells(overlay_rect)
+            cell_rects.append(overlay_rect)
+        timer.Mark("draw")
+        pygame.display.update(panel_rects + cell_rects)
+        timer.Mark("display")
 
-        # check for user events:
+        # check for user events, changes are sent to the simulation thread:
+        view = (viewport.level, viewport.cell_size, viewport.row, viewport.col)
         for event in pygame.event.get():
-            if event.type == QUIT:
+            if event.type == pygame.QUIT:
+                simulation.Stop()
                 pygame.quit()
                 return
-            elif  event.type == KEYDOWN:
-                if event.key in [K_ESCAPE, K_q]:
+            elif event.type == pygame.VIDEOEXPOSE:
+                redraw_all = True
+            elif  event.type == pygame.KEYDOWN:
+                if event.key in [pygame.K_ESCAPE, pygame.K_q]:
+                    simulation.Stop()
                     pygame.quit()
                     return
-                elif event.key == K_SPACE:
+                elif event.key == pygame.K_SPACE:
                     if VERBOSE: print "Space pressed, toggle running."
                     running = not running
-            elif event.type == MOUSEBUTTONDOWN:
-                if button_start.IsPressed(pygame.mouse.get_pos()):
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                    running = True
-                    if VERBOSE: print "Starting simulation."
-                elif button_pause.IsPressed(pygame.mouse.get_pos()):
+                    simulation.Send("running", running)
+                elif event.key == pygame.K_o:
+                    show_overlay = not show_overlay
+                    redraw_all = True
+                elif event.key == pygame.K_t:
+                    filename = timer.SaveTrace(get_filename("SpirallingCells_trace_", CA.num_states, \
+                                               CA.cell_size, CA.width, CA.height, "json"))
+                    if VERBOSE: print "Frame timings saved, filename:", filename
+                elif event.key == pygame.K_p:
+                    if profiler is None:
+                        profiler = cProfile.Profile()
+                        profiled_frames = 0
+                        profiler.enable()
+                        simulation.StartProfile()
+                        if VERBOSE: print "Profiling next", PROFILE_FRAMES, "frames."
+                    else:
+                        profiled_frames = PROFILE_FRAMES
+                elif event.key in [pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT]:
+                    rows = {pygame.K_UP: -1, pygame.K_DOWN: 1}.get(event.key, 0)
+                    cols = {pygame.K_LEFT: -1, pygame.K_RIGHT: 1}.get(event.key, 0)
+                    viewport.Pan(rows, cols, shown_CA.height, shown_CA.width)
+                elif event.key in [pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS]:
+                    viewport.Zoom(1, shown_CA.height, shown_CA.width)
+                elif event.key in [pygame.K_MINUS, pygame.K_KP_MINUS]:
+                    viewport.Zoom(-1, shown_CA.height, shown_CA.width)
+                elif event.key == pygame.K_HOME:
+                    viewport = Viewport(cell_size)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in [4, 5]:
+                # mouse wheel zooms cell area:
+                if event.pos[0] < MAIN_WIDTH:
+                    viewport.Zoom(1 if event.button == 4 else -1, shown_CA.height, shown_CA.width)
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                command, value = panel.HitTest(event.pos)
+                if command in ["start", "neighbourhood", "num_states", "cell_size"]:
+                    if command == "start":
+                        running = True
+                        if VERBOSE: print "Starting simulation."
+                    elif command == "neighbourhood":
+                        if VERBOSE: print value, "Neighbourhood selected."
+                        neighbourhood = value
+                    elif command == "num_states":
+                        if VERBOSE: print "Selected number of states:", value
+                        num_states = value
+                    else:
+                        if VERBOSE: print "Selected cell size:", value
+                        cell_size = value
+                        viewport = Viewport(cell_size)
+                    CA = CellularAutomaton(grid_width or MAIN_WIDTH // cell_size,
+                                           grid_height or HEIGHT // cell_size, num_states, cell_size)
+                    simulation.Send("automaton", CA)
+                    simulation.Send("neighbourhood", neighbourhood)
+                    simulation.Send("running", running)
+                elif command == "pause":
                     running = False
+                    simulation.Send("running", running)
                     if VERBOSE: print "Pausing simulation."
-                elif button_continue.IsPressed(pygame.mouse.get_pos()):
+                elif command == "continue":
                     running = True
+                    simulation.Send("running", running)
                     if VERBOSE: print "Continuing simulation."
-                elif button_restart.IsPressed(pygame.mouse.get_pos()):
-                    running = True
+                elif command == "restart":
                     if VERBOSE: print "Restarting simulation."
-                    CA.ResetGrid()
                     running = True
-                elif button_neighbourhood_neumann.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Von Neumann Neighbourhood selected."
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                    neighbourhood = "von Neumann"
-                elif button_neighbourhood_moore.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Moore Neighbourhood selected."
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                    neighbourhood = "Moore"
-                elif button_ncell_4.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected number of states: 4"
-                    num_states = 4
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_ncell_8.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected number of states: 8"
-                    num_states = 8
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_ncell_12.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected number of states: 12"
-                    num_states = 12
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_ncell_16.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected number of states: 16"
-                    num_states = 16
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_save_current.IsPressed(pygame.mouse.get_pos()):
-                    filename = CA.SaveCurrent(neighbourhood)
+                    simulation.Send("restart")
+                    simulation.Send("running", running)
+                elif command == "save_current":
+                    filename = simulation.Call("SaveCurrent", neighbourhood)
                     if VERBOSE: print "Current state saved, filename:", filename
-                elif button_save_initial.IsPressed(pygame.mouse.get_pos()):
-                    filename = CA.SaveInitial(neighbourhood)
+                elif command == "save_initial":
+                    filename = simulation.Call("SaveInitial", neighbourhood)
                     if VERBOSE: print "Initial state saved, filename:", filename
-                elif button_save_image.IsPressed(pygame.mouse.get_pos()):
-                    filename = CA.SaveImage(surface)
+                elif command == "save_image":
+                    filename = shown_CA.SaveImage(surface)
                     if VERBOSE: print "Image saved, filename:", filename
-                elif button_load_current.IsPressed(pygame.mouse.get_pos()):
-                    neighbourhood = CA.LoadState()
+                elif command == "load":
+                    neighbourhood = simulation.Call("LoadFile", ask_open_filename())
+                    simulation.Send("neighbourhood", neighbourhood)
+                    # show the loaded grid with its own cell size and states:
+                    num_states = CA.num_states
+                    cell_size = CA.cell_size
+                    viewport = Viewport(cell_size)
+                    simulation.Send("viewport", copy.copy(viewport))
+                    redraw_all = True
                     if VERBOSE: print "Data loaded."
-                elif button_cell_size1.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected cell size: 1"
-                    cell_size = 1
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_cell_size2.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected cell size: 2"
-                    cell_size = 2
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_cell_size3.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected cell size: 3"
-                    cell_size = 3
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_cell_size4.IsPressed(pygame.mouse.get_pos()):
-                    if VERBOSE: print "Selected cell size: 4"
-                    cell_size = 4
-                    CA = CellularAutomaton(MAIN_WIDTH // cell_size, HEIGHT // cell_size, num_states, cell_size)
-                elif button_toggle_entropy.IsPressed(pygame.mouse.get_pos()):
+                elif command == "min_dist":
                     show_mindist = not show_mindist
-                    if show_mindist:
-                        button_toggle_entropy.SetText("switch off")
-                    else:
-                        button_toggle_entropy.SetText("switch on")
+                    simulation.Send("min_dist", show_mindist)
+                    panel.SetButtonText("min_dist", "switch off" if show_mindist else "switch on")
                     if VERBOSE: print "Entropy on!" if show_mindist else "Entropy off!"
-                elif button_quit.IsPressed(pygame.mouse.get_pos()):
+                elif command == "gens_per_frame":
+                    position = GENS_PER_FRAME.index(gens_per_frame) + value
+                    gens_per_frame = GENS_PER_FRAME[max(0, min(position, len(GENS_PER_FRAME) - 1))]
+                    simulation.Send("steps", gens_per_frame)
+                    if VERBOSE: print "Generations per frame:", gens_per_frame if gens_per_frame else "auto"
+                elif command == "quit":
                     if VERBOSE: print "Quit pressed!"
+                    simulation.Stop()
                     pygame.quit()
                     return
+        if (viewport.level, viewport.cell_size, viewport.row, viewport.col) != view:
+            simulation.Send("viewport", copy.copy(viewport))
+            if VERBOSE: print "View: level", viewport.level, "with", viewport.cell_size, \
+                              "pixels per cell, top left cell", (viewport.row, viewport.col)
+        timer.Mark("events")
+        timer.EndFrame(generations, generations * shown_CA.num_cells, spans)
+
+        # stop cProfile capture after PROFILE_FRAMES frames and save it
+        # together with the capture of the simulation thread:
+        if profiler is not None:
+            profiled_frames += 1
+            if profiled_frames >= PROFILE_FRAMES:
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+                stats.add(simulation.StopProfile())
+                filename = get_filename("SpirallingCells_profile_", CA.num_states, CA.cell_size, \
+                                        CA.width, CA.height, "prof")
+                stats.dump_stats(filename)
+                profiler = None
+                if VERBOSE: print "Profile saved, filename:", filename
                 
            
                     
 ######################################################################
-#                         
-# initialize PyGame:
-if VERBOSE: print "Initializing...",
-if HEIGHT + HEADER_HEIGHT < 800:
-    print "Sorry, we need a total height of at least 800 pixels."
-elif MAIN_WIDTH + MENU_WIDTH < 1000:
-    "Sorry, we need a total width of at least 1000 pixels."
-else:
-    start_timer = timeit.default_timer()
+#
+# Parallel stepping: the toroidal grid is split into horizontal strips, one
+# per worker process. Two grid buffers live in shared memory, workers read
+# their strip plus one halo row above and below (wrapping around) from the
+# current buffer and write the next generation of their strip into the
+# other one, so halos are exchanged through shared memory. The cells changed
+# in the strip are marked in a shared boolean grid:
+def parallel_worker(conn, buffers, changed_buffer, width, height, row1, row2, num_states, offsets):
+    grids = [np.frombuffer(buf, dtype=CELL_DTYPE).reshape(height, width) for buf in buffers]
+    changed = np.frombuffer(changed_buffer, dtype=bool).reshape(height, width)
+    halo_rows = np.arange(row1 - 1, row2 + 1) % height
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        current, neighbourhood = message
+        strip = grids[current][halo_rows]
+        target = (strip + 1) % num_states
+        mask = np.zeros(strip.shape, dtype=bool)
+        for row_off, col_off in offsets[neighbourhood]:
+            mask |= np.roll(strip, (-row_off, -col_off), axis=(0, 1)) == target
+        grids[1 - current][row1:row2] = np.where(mask, target, strip)[1:-1]
+        changed[row1:row2] = mask[1:-1]
+        conn.send(True)
+    conn.close()
+
+
+class ParallelStepper():
+
+    def __init__(self, width, height, num_states, offsets, workers):
+        # start worker processes, each owns a strip of at least 3 rows:
+        self.width = width
+        self.height = height
+        self.num_states = num_states
+        self.buffers = [multiprocessing.RawArray("B", width * height) for i in range(2)]
+        self.grids = [np.frombuffer(buf, dtype=CELL_DTYPE).reshape(height, width) \
+                      for buf in self.buffers]
+        self.changed_buffer = multiprocessing.RawArray("B", width * height)
+        self.changed = np.frombuffer(self.changed_buffer, dtype=bool).reshape(height, width)
+        self.current = 0
+        workers = max(1, min(workers, height // 3))
+        bounds = [height * i // workers for i in range(workers + 1)]
+        self.connections = []
+        self.processes = []
+        for i in range(workers):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=parallel_worker,
+                                              args=(child_conn, self.buffers, self.changed_buffer,
+                                                    width, height, bounds[i], bounds[i + 1],
+                                                    num_states, offsets))
+            process.daemon = True
+            process.start()
+            self.connections.append(conn)
+            self.processes.append(process)
+
+    def Fits(self, CA):
+        # check whether workers were started for the dimensions of CA:
+        return (self.width, self.height, self.num_states) == (CA.width, CA.height, CA.num_states)
+
+    def Step(self, grid, neighbourhood):
+        # evolve grid one generation, returns the new grid which is a view
+        # of the shared buffer, the changed cells are marked in self.changed:
+        if grid is not self.grids[self.current]:
+            self.grids[self.current][:] = grid
+        for conn in self.connections:
+            conn.send((self.current, neighbourhood))
+        for conn in self.connections:
+            conn.recv()
+        self.current = 1 - self.current
+        return self.grids[self.current]
+
+    def Stop(self):
+        for conn in self.connections:
+            conn.send(None)
+        for process in self.processes:
+            process.join()
+
+
+######################################################################
+#
+# Trajectory files store whole runs: after a header (magic, format version,
+# num_states, width, height, cell_size, neighbourhood, keyframe interval)
+# records are appended, each with record type, iteration and payload size.
+# Payloads are zlib compressed, keyframes (type 0) hold the grid, deltas
+# (type 1) the number of changed cells, their flat indices (uint32) and
+# their new states.
+# An index file (filename + ".idx") lists type, iteration and offset of
+# every record, so replays can seek without re-simulating:
+class TrajectoryRecorder():
+
+    def __init__(self, filename, CA, neighbourhood, keyframe_interval=KEYFRAME_INTERVAL):
+        # open files, start writer thread and record current grid as keyframe:
+        self.filename = filename
+        self.keyframe_interval = keyframe_interval
+        self.f = open(filename, "wb")
+        self.f.write(TRAJECTORY_HEADER.pack(TRAJECTORY_MAGIC, 1, CA.num_states, CA.width,
+                                            CA.height, CA.cell_size,
+                                            NEIGHBOURHOODS.index(neighbourhood),
+                                            keyframe_interval))
+        self.index = open(filename + ".idx", "wb")
+        self.queue = Queue.Queue(RECORDER_QUEUE)
+        self.writer = threading.Thread(target=self.WriteRecords)
+        self.writer.daemon = True
+        self.writer.start()
+        self.last_iteration = None
+        self.last_keyframe = None
+        self.previous = None
+        self.Record(CA)
+
+    def Record(self, CA):
+        # queue current generation as keyframe or delta, only copies data,
+        # compressing and writing is done by the writer thread:
+        grid = np.asarray(CA.grid, dtype=CELL_DTYPE)
+        consecutive = self.last_iteration is not None and CA.iterations == self.last_iteration + 1
+        if not consecutive or CA.iterations - self.last_keyframe >= self.keyframe_interval:
+            self.queue.put((0, CA.iterations, grid.copy()))
+            self.last_keyframe = CA.iterations
+        else:
+            changed = CA.ChangedCells()
+            if changed is None:
+                changed = np.flatnonzero(grid != self.previous)
+            self.queue.put((1, CA.iterations, (changed.astype(np.uint32), grid.reshape(-1)[changed])))
+        # engines without changed cells need the previous grid for deltas:
+        self.previous = grid.copy() if CA.ChangedCount() is None else None
+        self.last_iteration = CA.iterations
+
+    def WriteRecords(self):
+        # writer thread, runs until None is queued:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            record_type, iteration, data = item
+            if record_type == 0:
+                payload = np.ascontiguousarray(data).tostring()
+            else:
+                changed, states = data
+                payload = struct.pack("<I", len(changed)) + changed.tostring() + states.tostring()
+            payload = zlib.compress(payload, 1)
+            self.index.write(TRAJECTORY_INDEX.pack(record_type, iteration, self.f.tell()))
+            self.f.write(TRAJECTORY_RECORD.pack(record_type, iteration, len(payload)))
+            self.f.write(payload)
+
+    def Close(self):
+        # wait for writer thread and close files:
+        self.queue.put(None)
+        self.writer.join()
+        self.f.close()
+        self.index.close()
+
+
+class TrajectoryReplay():
+
+    def __init__(self, filename):
+        # read header and index of a trajectory file, the index is rebuilt
+        # from the records if the index file is missing:
+        self.f = open(filename, "rb")
+        values = TRAJECTORY_HEADER.unpack(self.f.read(TRAJECTORY_HEADER.size))
+        magic, version, self.num_states, self.width, self.height, self.cell_size, \
+               neighbourhood, self.keyframe_interval = values
+        if magic != TRAJECTORY_MAGIC:
+            raise ValueError("not a SpirallingCells trajectory file: " + filename)
+        self.neighbourhood = NEIGHBOURHOODS[neighbourhood]
+        self.records = []
+        if os.path.exists(filename + ".idx"):
+            data = open(filename + ".idx", "rb").read()
+            for start in range(0, len(data) - TRAJECTORY_INDEX.size + 1, TRAJECTORY_INDEX.size):
+                self.records.append(TRAJECTORY_INDEX.unpack(data[start:start + TRAJECTORY_INDEX.size]))
+        else:
+            offset = TRAJECTORY_HEADER.size
+            while True:
+                self.f.seek(offset)
+                data = self.f.read(TRAJECTORY_RECORD.size)
+                if len(data) < TRAJECTORY_RECORD.size:
+                    break
+                record_type, iteration, size = TRAJECTORY_RECORD.unpack(data)
+                self.records.append((record_type, iteration, offset))
+                offset += TRAJECTORY_RECORD.size + size
+        self.iterations = [record[1] for record in self.records]
+        self.grid = None
+        self.position = None    # index of record self.grid corresponds to
+
+    def ReadPayload(self, position):
+        record_type, iteration, offset = self.records[position]
+        self.f.seek(offset)
+        size = TRAJECTORY_RECORD.unpack(self.f.read(TRAJECTORY_RECORD.size))[2]
+        return zlib.decompress(self.f.read(size))
+
+    def Seek(self, iteration):
+        # return grid at given iteration: start at the last keyframe before
+        # it (or the current position, if closer) and apply the deltas:
+        if iteration not in self.iterations:
+            raise ValueError("iteration %d not recorded" % iteration)
+        target = len(self.iterations) - 1 - self.iterations[::-1].index(iteration)
+        keyframe = target
+        while self.records[keyframe][0] != 0:
+            keyframe -= 1
+        if self.position is None or not keyframe <= self.position <= target:
+            payload = self.ReadPayload(keyframe)
+            self.grid = np.frombuffer(payload, dtype=CELL_DTYPE) \
+                          .reshape(self.height, self.width).copy()
+            self.position = keyframe
+        flat = self.grid.reshape(-1)
+        for position in range(self.position + 1, target + 1):
+            payload = self.ReadPayload(position)
+            if self.records[position][0] == 0:
+                flat[:] = np.frombuffer(payload, dtype=CELL_DTYPE)
+                continue
+            count = struct.unpack("<I", payload[:4])[0]
+            changed = np.frombuffer(payload, dtype=np.uint32, count=count, offset=4)
+            flat[changed] = np.frombuffer(payload, dtype=CELL_DTYPE, count=count, offset=4 + 4 * count)
+        self.position = target
+        return self.grid.copy()
+
+    def Close(self):
+        self.f.close()
+
+
+######################################################################
+#
+# Movie export: every stride-th generation is taken directly from the grid
+# (not from the window), scaled by scale pixels per cell and encoded by a
+# background thread. Files ending in ".gif" become animated GIFs with the
+# colours of PALETTE as colour table, each frame only covers the rectangle
+# of pixels changed since the previous frame. Any other filename gets raw
+# RGB frames (8 bit per channel, no header) for video encoders, e.g.
+#   ffmpeg -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT -r 25 -i run.rgb run.mp4
+class FrameExporter():
+
+    def __init__(self, filename, width, height, stride=1, scale=1, delay=GIF_DELAY):
+        # width and height of grid in cells:
+        self.filename = filename
+        self.stride = stride
+        self.scale = scale
+        self.width = width * scale
+        self.height = height * scale
+        self.delay = delay
+        self.gif = filename.lower().endswith(".gif")
+        self.frames = 0
+        self.previous = None
+        self.f = open(filename, "wb")
+        if self.gif:
+            self.WriteGifHeader()
+        self.queue = Queue.Queue(EXPORT_QUEUE)
+        self.writer = threading.Thread(target=self.WriteFrames)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def Add(self, CA):
+        # queue current generation if its iteration is a multiple of stride,
+        # only the grid is copied, blocks while EXPORT_QUEUE frames wait:
+        if CA.iterations % self.stride == 0:
+            self.queue.put(np.array(CA.grid, dtype=CELL_DTYPE))
+            self.frames += 1
+
+    def WriteFrames(self):
+        # writer thread, runs until None is queued:
+        while True:
+            grid = self.queue.get()
+            if grid is None:
+                break
+            if self.scale > 1:
+                grid = grid.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+            if self.gif:
+                self.WriteGifFrame(grid)
+            else:
+                self.f.write(PALETTE_RGB[grid].tostring())
+
+    def WriteGifHeader(self):
+        # GIF89a header with global colour table (16 colours) and NETSCAPE2.0
+        # extension for endless looping:
+        self.f.write("GIF89a" + struct.pack("<HHBBB", self.width, self.height, 0xf3, 0, 0))
+        self.f.write(PALETTE_RGB.tostring())
+        self.f.write("\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    def WriteGifFrame(self, pixels):
+        # write changed rectangle of pixels as image with graphic control
+        # extension (delay, keep previous image), an unchanged frame still
+        # gets a 1x1 image so the timing is kept:
+        if self.previous is None:
+            top, left, bottom, right = 0, 0, self.height, self.width
+        else:
+            changed = pixels != self.previous
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            if len(rows):
+                top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            else:
+                top, left, bottom, right = 0, 0, 1, 1
+        self.previous = pixels
+        self.f.write(struct.pack("<BBBBHBB", 0x21, 0xf9, 4, 0x04, self.delay, 0, 0))
+        self.f.write(struct.pack("<BHHHHB", 0x2c, left, top, right - left, bottom - top, 0))
+        data = gif_literal_codes(pixels[top:bottom, left:right], 4)
+        self.f.write("\x04")
+        for i in range(0, len(data), 255):
+            self.f.write(chr(len(data[i:i + 255])) + data[i:i + 255])
+        self.f.write("\x00")
+
+    def Close(self):
+        # wait for writer thread and close file, returns number of frames:
+        self.queue.put(None)
+        self.writer.join()
+        if self.gif:
+            self.f.write("\x3b")
+        self.f.close()
+        return self.frames
+
+
+# GIF image data (LZW code stream) without compression, so it can be
+# computed with whole-array operations: every pixel (colour index below
+# 2**min_code_size) is written as a code of its own, a clear code before
+# every run of 2**min_code_size - 4 pixels keeps the decoder's code table
+# (and so the code size) from growing. Files are about twice as large as
+# with LZW compression, but encoding takes about as long as one generation
+# instead of 30 times as long:
+def gif_literal_codes(pixels, min_code_size):
+    clear = 1 << min_code_size
+    run = clear - 4
+    pixels = pixels.reshape(-1)
+    runs = -(-len(pixels) // run)
+    codes = np.empty((runs, run + 1), dtype=np.uint16)
+    codes[:, 0] = clear
+    codes[:, 1:] = np.append(pixels, np.zeros(runs * run - len(pixels), dtype=pixels.dtype)).reshape(runs, run)
+    codes = np.append(codes.reshape(-1)[:len(pixels) + runs], clear + 1)
+    return pack_codes(codes, min_code_size + 1)
+
+# pack codes of size bits (at most 8) into bytes, least significant bit
+# first: each group of 8 codes fills size bytes of a little-endian uint64:
+def pack_codes(codes, size):
+    groups = np.append(codes, np.zeros(-len(codes) % 8, dtype=codes.dtype)).astype(np.uint64)
+    groups = groups.reshape(-1, 8) << (np.arange(8, dtype=np.uint64) * np.uint64(size))
+    words = np.bitwise_or.reduce(groups, axis=1).astype("<u8")
+    data = words.view(np.uint8).reshape(-1, 8)[:, :size].tostring()
+    return data[:(len(codes) * size + 7) // 8]
+
+
+######################################################################
+#
+# headless batch run, no window and no GUI packages needed:
+def run_batch(width, height, num_states, neighbourhood, seed, iterations,
+              engine=ENGINE, prefix="SpirallingCells_batch_", workers=WORKERS, compress=False,
+              record=None, cycles="off", export=None, stride=1, scale=1, min_dist_error=None):
+    # cycles: "stop" ends the run when a fixed point or cycle is detected,
+    # "jump" skips whole periods to the last iteration. export is a GIF or
+    # raw movie file, see FrameExporter. With min_dist_error the Min Dist
+    # value of every step is estimated within that error (EstimateEntropy)
+    # and written to the timings file:
+    CA = CellularAutomaton(width, height, num_states, 1, random_start=False, engine=engine,
+                           workers=workers)
+    CA.InitializeRandomly(seed)
+    if record:
+        CA.StartRecording(record, neighbourhood)
+    if cycles != "off":
+        CA.StartCycleDetection()
+    exporter = None
+    if export:
+        exporter = FrameExporter(export, width, height, stride, scale)
+        exporter.Add(CA)
+    timings = []
+    active_cells = []
+    min_dists = []
+    for i in range(iterations):
+        step_start = timeit.default_timer()
+        CA.EvolveOneStep(neighbourhood)
+        timings.append(timeit.default_timer() - step_start)
+        active_cells.append(CA.active_cells)
+        if min_dist_error:
+            min_dists.append(CA.EstimateEntropy(neighbourhood, min_dist_error, [seed or 0, i]))
+        if exporter is not None:
+            exporter.Add(CA)
+        if VERBOSE and (i + 1) % 100 == 0:
+            print "Iteration", i + 1, "of", iterations
+        if cycles != "off" and CA.period is not None:
+            if VERBOSE:
+                print "Cycle of period", CA.period, "found at iteration", CA.iterations, \
+                      "(first seen at iteration %d)." % CA.cycle_start
+            if cycles == "jump":
+                CA.JumpTo(neighbourhood, iterations)
+                if VERBOSE: print "Jumped to iteration", CA.iterations
+            break
+    CA.StopWorkers()
+    CA.StopRecording()
+    if exporter is not None:
+        frames = exporter.Close()
+    state_file = CA.SaveCurrent(neighbourhood, get_filename(prefix + "current_", num_states, \
+                                1, width, height, "cells"), compress)
+    timings_file = get_filename(prefix + "timings_", num_states, 1, width, height, "csv")
+    f = open(timings_file, "w")
+    f.write("iteration,seconds,active_cells%s\n" % (",min_dist,min_dist_error" if min_dists else ""))
+    for i, t in enumerate(timings):
+        f.write("%d,%.6f,%d" % (i + 1, t, active_cells[i]))
+        f.write(",%.6f,%.6f\n" % min_dists[i] if min_dists else "\n")
+    f.close()
+    if VERBOSE:
+        print "Final state saved, filename:", state_file
+        print "Step timings saved, filename:", timings_file
+        if timings:
+            print "Mean time per step:", sum(timings) / len(timings)
+        if min_dists:
+            print "Final Min Dist: %.6f +- %.6f" % min_dists[-1]
+        if record:
+            print "Trajectory saved, filename:", record
+        if CA.block_cache is not None:
+            print "Block cache: %(hits)d hits, %(misses)d misses (hit rate %(hit_rate).3f), " \
+                  "%(evictions)d evictions, %(size)d blocks cached" % CA.block_cache.Statistics()
+        if export:
+            print frames, "frames exported (%dx%d pixels), filename:" % (exporter.width, exporter.height), \
+                  export
+    return CA
+
+# extract grid at given iteration from trajectory file as snapshot file:
+def extract_iteration(trajectory_file, iteration, compress=False):
+    replay = TrajectoryReplay(trajectory_file)
+    grid = replay.Seek(iteration)
+    replay.Close()
+    filename = trajectory_file.rsplit(".", 1)[0] + "_%d.cells" % iteration
+    return save_snapshot(filename, grid, replay.num_states, replay.cell_size,
+                         replay.neighbourhood, iteration, compress)
+
+
+######################################################################
+#
+# Ensemble runs: a sweep specification (JSON file) lists values for
+# num_states, neighbourhood, size ([width, height]) and seeds (list or
+# number of seeds), plus iterations and sample_every, e.g.
+#
+#   {"num_states": [4, 8, 12, 16], "neighbourhood": ["von Neumann", "Moore"],
+#    "size": [[200, 200], [400, 400]], "seeds": 10,
+#    "iterations": 2000, "sample_every": 10}
+#
+# With "min_dist_error" (e.g. 0.01) min_dist is estimated from sampled
+# cells within that error (95% confidence, see EstimateEntropy) instead of
+# computed from all cells, the error goes to column min_dist_error.
+# Every combination is one run, runs are distributed over a process pool.
+# Each run stops early when it has stabilised (fixed point or cycle).
+# Rows of a finished run are appended to the results file (CSV), its id
+# and the file size after writing go to the progress file (results file +
+# ".progress"), so an interrupted sweep continues with the missing runs.
+ENSEMBLE_COLUMNS = ["run", "num_states", "neighbourhood", "width", "height", "seed",
+                    "iteration", "changed_cells", "min_dist", "min_dist_error", "stabilised_at",
+                    "period"]
+
+# list of runs (dictionaries) for sweep specification:
+def ensemble_runs(spec):
+    seeds = spec.get("seeds", 1)
+    if isinstance(seeds, int):
+        seeds = range(seeds)
+    runs = []
+    for states, neighbourhood, size, seed in itertools.product(
+            spec.get("num_states", [num_states]),
+            spec.get("neighbourhood", ["von Neumann"]),
+            spec.get("size", [[MAIN_WIDTH // 2, HEIGHT // 2]]), seeds):
+        neighbourhood = str(neighbourhood)
+        width, height = size
+        runs.append({"run": "%d_%s_%dx%d_%d" % (states, neighbourhood.replace(" ", ""),
+                                                width, height, seed),
+                     "num_states": states, "neighbourhood": neighbourhood,
+                     "width": width, "height": height, "seed": seed,
+                     "iterations": spec.get("iterations", 1000),
+                     "sample_every": spec.get("sample_every", 1),
+                     "min_dist_error": spec.get("min_dist_error")})
+    return runs
+
+# evolve one member of an ensemble, runs in pool process, returns rows:
+def run_ensemble_member(run):
+    CA = CellularAutomaton(run["width"], run["height"], run["num_states"], 1,
+                           random_start=False)
+    CA.InitializeRandomly(run["seed"])
+    CA.StartCycleDetection()
+    neighbourhood = run["neighbourhood"]
+    columns = [run["run"], run["num_states"], neighbourhood, run["width"], run["height"],
+               run["seed"]]
+    rows = []
+    while CA.iterations < run["iterations"] and CA.period is None:
+        CA.EvolveOneStep(neighbourhood)
+        if CA.iterations % run["sample_every"] == 0 or CA.period is not None:
+            changed = CA.ChangedCount()
+            changed = changed if changed is not None else ""
+            if run["min_dist_error"]:
+                min_dist, error = CA.EstimateEntropy(neighbourhood, run["min_dist_error"],
+                                                     [run["seed"], CA.iterations])
+            else:
+                min_dist, error = CA.GetEntropy(neighbourhood), 0.0
+            rows.append(columns + [CA.iterations, changed, "%.6f" % min_dist, "%.6f" % error,
+                                   "", ""])
+    if CA.period is not None and rows:
+        rows[-1][-2:] = [CA.cycle_start, CA.period]
+    return run["run"], rows
+
+# run all members of ensemble on processes worker processes:
+def run_ensemble(spec_file, results_file=None, processes=WORKERS):
+    spec = json.load(open(spec_file))
+    if results_file == None:
+        results_file = spec_file.rsplit(".", 1)[0] + "_results.csv"
+    progress_file = results_file + ".progress"
+    # read progress, drop rows of runs which were not finished:
+    done = set()
+    size = 0
+    if os.path.exists(progress_file) and os.path.exists(results_file):
+        for line in open(progress_file):
+            run_id, size = line.split()
+            done.add(run_id)
+            size = int(size)
+    f = open(results_file, "ab" if done else "wb")
+    f.truncate(size)
+    f.seek(size)
+    progress = open(progress_file, "a" if done else "w")
+    if not done:
+        f.write(",".join(ENSEMBLE_COLUMNS) + "\n")
+    runs = [run for run in ensemble_runs(spec) if run["run"] not in done]
+    if VERBOSE: print "Ensemble:", len(runs), "runs to do,", len(done), "already done."
+    pool = multiprocessing.Pool(processes)
+    for count, (run_id, rows) in enumerate(pool.imap_unordered(run_ensemble_member, runs)):
+        f.write("".join(",".join(str(value) for value in row) + "\n" for row in rows))
+        f.flush()
+        os.fsync(f.fileno())
+        progress.write("%s %d\n" % (run_id, f.tell()))
+        progress.flush()
+        if VERBOSE: print "Run", run_id, "finished (%d of %d)." % (count + 1, len(runs))
+    pool.close()
+    pool.join()
+    f.close()
+    progress.close()
+    return results_file
+
+
+######################################################################
+#
+# Benchmarks: stepping engines, drawing (offscreen surface), Min Dist,
+# random initialization and snapshot save/load are timed for all
+# combinations of BENCHMARK_SIZES, BENCHMARK_STATES and neighbourhoods,
+# with fixed seeds. Results are written as JSON file, if a baseline file
+# (written by an earlier benchmark run) is given, cases whose best time
+# got worse by more than BENCHMARK_TOLERANCE are reported as regressions.
+
+# time repeats calls of function, setup is called (untimed) before each:
+def time_calls(function, repeats, setup=None):
+    times = []
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+    return times
+
+# list of benchmark cases (name, parameters, function, setup) for one
+# combination of grid size, number of states and neighbourhood:
+def benchmark_cases(size, states, neighbourhood, surface, directory):
+    def new_CA(engine=ENGINE):
+        CA = CellularAutomaton(size, size, states, max(1, MAIN_WIDTH // size),
+                               random_start=False, engine=engine)
+        CA.InitializeRandomly(BENCHMARK_SEED)
+        for i in range(BENCHMARK_WARMUP):
+            CA.EvolveOneStep(neighbourhood)
+        return CA
+    params = {"size": size, "num_states": states, "neighbourhood": neighbourhood}
+    nb = neighbourhood
+    cases = []
+    for engine in ["active", "numpy", "memo"]:
+        cases.append(("step_" + engine, lambda CA=new_CA(engine): CA.EvolveOneStep(nb), None))
+    CA = new_CA()
+    cases.append(("init", lambda CA=CA: CA.InitializeRandomly(BENCHMARK_SEED), None))
+    CA = new_CA()
+    cases.append(("entropy_full", lambda CA=CA: CA.GetEntropy(nb), CA.GridReplaced))
+    CA = new_CA()
+    cases.append(("entropy_incremental", lambda CA=CA: CA.GetEntropy(nb),
+                  lambda CA=CA: (CA.GetEntropy(nb), CA.EvolveOneStep(nb))))
+    CA = new_CA()
+    cases.append(("entropy_sampled", lambda CA=CA: CA.EstimateEntropy(nb, seed=BENCHMARK_SEED),
+                  None))
+    if surface is not None:
+        CA = new_CA()
+        cases.append(("draw_full", lambda CA=CA: CA.DrawCells(surface, full=True), None))
+        CA = new_CA()
+        cases.append(("draw_incremental", lambda CA=CA: CA.DrawCells(surface),
+                      lambda CA=CA: CA.EvolveOneStep(nb)))
+    CA = new_CA()
+    loaded = CellularAutomaton(1, 1, states, 1, random_start=False)
+    for compress in [False, True]:
+        suffix = "_compressed" if compress else ""
+        filename = os.path.join(directory, "benchmark%s.cells" % suffix)
+        cases.append(("save" + suffix, lambda CA=CA, filename=filename, compress=compress: \
+                          CA.SaveCurrent(nb, filename, compress), None))
+        # loading includes reading all cells, otherwise memory-mapping is not timed fairly:
+        cases.append(("load" + suffix, lambda filename=filename: \
+                          (loaded.LoadFile(filename), int(loaded.grid.sum())), None))
+    return [(name, params, function, setup) for name, function, setup in cases]
+
+# key identifying a benchmark case in results and baseline:
+def benchmark_key(name, params):
+    return "%s/size=%d/num_states=%d/neighbourhood=%s" % (name, params["size"], params["num_states"],
+                                                          params["neighbourhood"])
+
+# run all benchmarks, write results to output file, compare with baseline:
+def run_benchmarks(output=None, baseline=None, repeats=BENCHMARK_REPEATS):
+    if output == None:
+        output = "SpirallingCells_benchmark_" + datetime.datetime.now().strftime("%Y%m%d_%H%M") + ".json"
+    try:
+        import_pygame()
+        surface = pygame.Surface((MAIN_WIDTH + MENU_WIDTH, HEIGHT + HEADER_HEIGHT))
+    except ImportError:
+        print "PyGame not available, skipping drawing benchmarks."
+        surface = None
+    directory = tempfile.mkdtemp()
+    results = []
+    for size, states, neighbourhood in itertools.product(BENCHMARK_SIZES, BENCHMARK_STATES,
+                                                          NEIGHBOURHOODS):
+        for name, params, function, setup in benchmark_cases(size, states, neighbourhood,
+                                                             surface, directory):
+            times = sorted(time_calls(function, repeats, setup))
+            result = {"case": benchmark_key(name, params), "name": name, "best": times[0],
+                      "median": times[len(times) // 2], "times": times}
+            result.update(params)
+            results.append(result)
+            if VERBOSE: print "%-70s %10.6f s" % (result["case"], result["median"])
+    shutil.rmtree(directory)
+    f = open(output, "w")
+    json.dump({"version": VERSION, "date": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(), "numpy": np.__version__,
+               "platform": platform.platform(), "repeats": repeats, "results": results},
+              f, indent=1, sort_keys=True)
+    f.close()
+    if VERBOSE: print "Benchmark results saved, filename:", output
+    regressions = []
+    if baseline:
+        regressions = compare_benchmarks(results, json.load(open(baseline))["results"])
+    return regressions
+
+# compare results with baseline results, returns list of regressed cases:
+def compare_benchmarks(results, baseline_results, tolerance=BENCHMARK_TOLERANCE):
+    baseline = dict((result["case"], result) for result in baseline_results)
+    regressions = []
+    for result in results:
+        if result["case"] not in baseline:
+            continue
+        ratio = result["best"] / max(baseline[result["case"]]["best"], 1e-9)
+        if ratio > 1 + tolerance:
+            regressions.append(result["case"])
+            print "REGRESSION %-59s %6.2fx slower" % (result["case"], ratio)
+    print len(regressions), "regressions in", len(results), "cases."
+    return regressions
+
+
+######################################################################
+#
+# initialize PyGame and start interactive mode:
+def run_gui():
+    global helv20, helv24, myfont24, myfont32, myfont64
+    if VERBOSE: print "Initializing...",
+    if HEIGHT + HEADER_HEIGHT < 800:
+        print "Sorry, we need a total height of at least 800 pixels."
+        return
+    elif MAIN_WIDTH + MENU_WIDTH < 1000:
+        print "Sorry, we need a total width of at least 1000 pixels."
+        return
+    import_gui()
     pygame.init()
-    helv20 = pygame.font.SysFont("Helvetica", 20)
-    helv24 = pygame.font.SysFont("Helvetica", 24)
+    helv20 = get_font("Helvetica", 20)
+    helv24 = get_font("Helvetica", 24)
     myfont24 = pygame.font.SysFont("monospace", 24)
     myfont32 = pygame.font.SysFont("monospace", 32)
     myfont64 = pygame.font.SysFont("monospace", 64)
-    flags = DOUBLEBUF
+    flags = pygame.DOUBLEBUF
     surface = pygame.display.set_mode((MAIN_WIDTH + MENU_WIDTH, HEIGHT + HEADER_HEIGHT), flags)
     surface.set_alpha(None)
     pygame.display.set_caption("SpirallingCells " + VERSION)
@@ -490,4 +2400,83 @@ else:
     if VERBOSE: print "Starting main loop."
     main_loop(surface)
 
+
+######################################################################
+#
+# parse command line, without --batch the interactive GUI is started:
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="SpirallingCells " + VERSION)
+    parser.add_argument("--batch", action="store_true",
+                        help="run headless, without window")
+    parser.add_argument("--width", type=int, default=None,
+                        help="grid width in cells, default fits window (%d)" % (MAIN_WIDTH // cell_size))
+    parser.add_argument("--height", type=int, default=None,
+                        help="grid height in cells, default fits window (%d)" % (HEIGHT // cell_size))
+    parser.add_argument("--states", type=int, default=num_states)
+    parser.add_argument("--neighbourhood", choices=["neumann", "moore"], default="neumann")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--engine", choices=ENGINES, default=ENGINE)
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="number of worker processes (parallel engine and --sweep)")
+    parser.add_argument("--convert", nargs="+", metavar="FILE",
+                        help="convert pickle files of earlier versions to snapshot files")
+    parser.add_argument("--compress", action="store_true",
+                        help="write compressed snapshot files")
+    parser.add_argument("--record", metavar="FILE",
+                        help="batch mode: record all generations to trajectory file")
+    parser.add_argument("--cycles", choices=["off", "stop", "jump"], default="off",
+                        help="batch mode: on detected fixed point or cycle stop the run, "
+                             "or jump ahead by whole periods to the last iteration")
+    parser.add_argument("--export", metavar="FILE",
+                        help="batch mode: export generations as animated GIF (.gif) "
+                             "or raw RGB frames (any other extension)")
+    parser.add_argument("--stride", type=int, default=1,
+                        help="export every STRIDE-th generation")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="pixels per cell in exported frames")
+    parser.add_argument("--min-dist-error", type=float, metavar="ERROR",
+                        help="batch mode: estimate Min Dist of every step from sampled cells "
+                             "within ERROR (95%% confidence), written to the timings file")
+    parser.add_argument("--sweep", metavar="SPEC",
+                        help="run ensemble described by JSON sweep specification")
+    parser.add_argument("--results", metavar="FILE",
+                        help="results file for --sweep (CSV) or --benchmark (JSON)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="run benchmarks, results are written to JSON file (see --results)")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare benchmarks with earlier results, exit code 1 on regressions")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="extract one iteration (see --at) from trajectory file")
+    parser.add_argument("--at", type=int, default=0,
+                        help="iteration to extract with --replay")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    start_timer = timeit.default_timer()
+    if args.convert:
+        for filename in args.convert:
+            new_filename = convert_pickle(filename, args.compress)
+            if VERBOSE: print "Converted", filename, "to", new_filename
+    elif args.sweep:
+        filename = run_ensemble(args.sweep, args.results, args.workers)
+        if VERBOSE: print "Ensemble results saved, filename:", filename
+    elif args.benchmark:
+        if run_benchmarks(args.results, args.baseline):
+            sys.exit(1)
+    elif args.replay:
+        filename = extract_iteration(args.replay, args.at, args.compress)
+        if VERBOSE: print "Iteration", args.at, "saved, filename:", filename
+    elif args.batch:
+        run_batch(args.width or MAIN_WIDTH // cell_size, args.height or HEIGHT // cell_size, args.states,
+                  "Moore" if args.neighbourhood == "moore" else "von Neumann",
+                  args.seed, args.iterations, args.engine, workers=args.workers,
+                  compress=args.compress, record=args.record,
+                  cycles=args.cycles, export=args.export, stride=args.stride,
+                  scale=args.scale, min_dist_error=args.min_dist_error)
+    else:
+        grid_width, grid_height = args.width, args.height
+        run_gui()
     if VERBOSE: print "CPU Usage:", timeit.default_timer() - start_timer